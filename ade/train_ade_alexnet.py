@@ -139,7 +139,7 @@ def train(train_loader, model_main, optimizer_m, epoch, criterion):
 
         # input and target
         input = input.cuda()
-        target = target.cuda(async=True)
+        target = target.cuda(non_blocking=True)
 
         # compute output
         predicted_labels = model_main(input)
@@ -190,7 +190,7 @@ def validate(val_loader, model_main, criterion):
     for i, (input, target, index) in enumerate(val_loader):
 
         input = input.cuda()
-        target = target.cuda(async=True)
+        target = target.cuda(non_blocking=True)
 
         # compute output
         output = model_main(input)
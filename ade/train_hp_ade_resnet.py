@@ -162,7 +162,7 @@ def train(train_loader, model_main, optimizer_m, epoch, criterion):
 
         # input and target
         input = input.cuda()
-        target = target.cuda(async=True)
+        target = target.cuda(non_blocking=True)
 
         # compute output
         predicted_labels = model_main(input)
@@ -217,9 +217,9 @@ def train_ap(train_loader, model_main, model_ahp_trunk, model_ahp_hp, optimizer_
 
         # # input and target
         # input = input.cuda()
-        # target = target.cuda(async=True)
+        # target = target.cuda(non_blocking=True)
 
-        target = target.cuda(async=True)
+        target = target.cuda(non_blocking=True)
         input_var = torch.autograd.Variable(input)
         target_var = torch.autograd.Variable(target)
 
@@ -284,7 +284,7 @@ def validate(val_loader, model_main, criterion, criterion_f):
     for i, (input, target, index) in enumerate(val_loader):
 
         input = input.cuda()
-        target = target.cuda(async=True)
+        target = target.cuda(non_blocking=True)
 
         # compute output
         output = model_main(input)
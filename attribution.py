@@ -0,0 +1,365 @@
+import contextlib
+
+import torch
+import torch.nn.functional as F
+
+
+def batched_class_gradients(output, feature, classes):
+    """Gradients of several class scores w.r.t. a feature map in one pass.
+
+    The one-hot selectors of all requested classes are stacked and pushed
+    through a single batched vector-Jacobian product instead of one
+    backward(retain_graph=True) per class.
+
+    output:  (B, num_classes) network output
+    feature: (B, C, H, W) activation recorded on the graph of output, or a
+             list of them for several layers
+    classes: (K,) class indices shared by the batch, or (B, K) per example
+    returns: (K, B, C, H, W) gradients, a tuple of them for a list of features
+    """
+    classes = torch.as_tensor(classes, dtype=torch.long, device=output.device)
+    if classes.dim() == 1:
+        classes = classes.unsqueeze(0).expand(output.size(0), -1)
+    one_hot = torch.zeros((classes.size(1),) + output.size(), dtype=output.dtype, device=output.device)
+    one_hot.scatter_(2, classes.t().unsqueeze(2), 1.0)
+    gradients = torch.autograd.grad(output, feature, grad_outputs=one_hot,
+                                    retain_graph=True, is_grads_batched=True)
+    return gradients if isinstance(feature, (list, tuple)) else gradients[0]
+
+
+def gradcam_maps(feature, gradients):
+    """Channel-summed activation x gradient maps, (..., C, H, W) -> (..., H, W)."""
+    return torch.sum(feature.detach() * gradients, dim=-3)
+
+
+def resample_maps(maps, size=None):
+    """Stacks the (..., H_i, W_i) maps of several layers into (L, ..., H, W).
+
+    Maps are bilinearly resampled to size, by default the finest grid among
+    them, so that layers of different resolution can be compared or fused.
+    """
+    if size is None:
+        size = (max(m.size(-2) for m in maps), max(m.size(-1) for m in maps))
+    size = tuple(size)
+    resampled = []
+    for m in maps:
+        if tuple(m.shape[-2:]) != size:
+            m = F.interpolate(m.reshape((-1, 1) + m.shape[-2:]), size=size, mode='bilinear',
+                              align_corners=False).view(m.shape[:-2] + size)
+        resampled.append(m)
+    return torch.stack(resampled)
+
+
+def fuse_layer_maps(maps):
+    """Averages (L, B, ...) layer maps into (1, B, ...) after scaling the map
+    of every layer and example to a maximum magnitude of one."""
+    scale = maps.abs().flatten(start_dim=2).max(dim=2)[0]
+    scale = torch.clamp(scale, min=1e-12).view(maps.shape[:2] + (1,) * (maps.dim() - 2))
+    return torch.mean(maps / scale, dim=0, keepdim=True)
+
+
+@contextlib.contextmanager
+def frozen_parameters(*models):
+    """Stop autograd from tracking (and filling .grad of) the weights of the given
+    models for the forward passes run inside the block. The graph recorded there
+    leaves them out for good, while their requires_grad flags are restored on
+    exit, so that a model shared with other attributions is left as it was."""
+    params = [param for model in models for param in model.parameters()]
+    flags = [param.requires_grad for param in params]
+    try:
+        for param in params:
+            param.requires_grad_(False)
+        yield
+    finally:
+        for param, flag in zip(params, flags):
+            param.requires_grad_(flag)
+
+
+def path_gradients(output, feature, classes=None):
+    """Gradients w.r.t. feature summed over the batch of path points.
+
+    classes=None differentiates the (summed) scalar output, e.g. the hardness
+    score, and returns (C, H, W); otherwise the (K,) classes are handled in one
+    batched pass and (K, C, H, W) is returned.
+    """
+    if classes is None:
+        return torch.autograd.grad(torch.sum(output), feature)[0].sum(dim=0)
+    return batched_class_gradients(output, feature, classes).sum(dim=1)
+
+
+def saved_tensor_bytes(forward, input):
+    """Runs forward(input) and counts the bytes autograd keeps for its backward.
+
+    returns (bytes, forward(input))
+    """
+    saved = [0]
+
+    def pack(tensor):
+        saved[0] += tensor.numel() * tensor.element_size()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        result = forward(input)
+    return saved[0], result
+
+
+def chunk_points(memory_budget, point_bytes, classes=None):
+    """Number of points per forward/backward that fits memory_budget (MB), a
+    point needing point_bytes for its backward. The batched backward over K
+    classes holds the gradients of all K classes at once, so a point then
+    costs K times as much."""
+    if classes is not None:
+        point_bytes = point_bytes * torch.as_tensor(classes).size(-1)
+    return max(1, int(memory_budget * 2 ** 20 // max(point_bytes, 1)))
+
+
+def sum_path_gradients(forward, input, refer_input, alphas, classes=None, chunk=1):
+    """Sums the gradients at refer_input + alpha * (input - refer_input) over alphas,
+    chunk points per forward/backward.
+
+    returns (summed gradients, feature and output at the last alpha)
+    """
+    total = 0
+    for start in range(0, len(alphas), chunk):
+        alpha = alphas[start:start + chunk].view((-1,) + (1,) * (input.dim() - 1))
+        feature, output = forward(refer_input + alpha * (input - refer_input))
+        total = total + path_gradients(output, feature, classes)
+    return total, feature[-1:].detach(), output[-1:].detach()
+
+
+def integrated_gradients(forward, input, refer_input, step, classes=None, memory_budget=2048):
+    """Integrated gradients at a target layer with vectorized path steps.
+
+    forward(x) returns (feature, output) for a batch x, feature being the
+    target layer activation on the graph of output. The step + 1 points
+    refer_input + (i / step) * (input - refer_input) are stacked along the
+    batch dimension and run in chunks sized to fit memory_budget (MB), judged
+    from the memory the reference point needs for its backward times the
+    number of classes (see chunk_points). Gradients are accumulated on the
+    device in float32.
+
+    returns (gradient averaged over the path, feature of input, feature of refer_input)
+    with gradients of shape (C, H, W), or (K, C, H, W) when classes are given
+    """
+    input = input.detach()
+    refer_input = refer_input.detach()
+    point_bytes, (refer_feature, output) = saved_tensor_bytes(forward, refer_input)
+    total = path_gradients(output, refer_feature, classes)
+    chunk = chunk_points(memory_budget, point_bytes, classes)
+
+    alphas = torch.arange(1, step + 1, dtype=input.dtype, device=input.device) / step
+    path_total, feature, _ = sum_path_gradients(forward, input, refer_input, alphas, classes, chunk)
+
+    return (total + path_total) / (step + 1), feature, refer_feature.detach()
+
+
+def summed_attribution(gradients, feature, refer_feature):
+    """Sum of the attributions (feature - refer_feature) * gradients, one per class."""
+    return torch.sum((feature - refer_feature)[0] * gradients, dim=(-3, -2, -1))
+
+
+def adaptive_integrated_gradients(forward, input, refer_input, classes=None, step=4, max_step=64,
+                                  tolerance=0.01, memory_budget=2048):
+    """Integrated gradients that doubles the number of steps until converged.
+
+    Starting from step intervals, the midpoints of the current intervals are
+    added (reusing every gradient computed so far) until the summed
+    attribution changes by less than tolerance between two refinements,
+    relative to the change f(input) - f(refer_input) of the output, or
+    max_step is reached. For classes the largest change over the K classes is
+    used. Completeness, the summed attribution matching that change, is not
+    tested: it only holds in the space the path is taken in, the input, not
+    at an intermediate layer.
+
+    returns (gradient averaged over the path, feature of input, feature of refer_input, steps used)
+    """
+    input = input.detach()
+    refer_input = refer_input.detach()
+    point_bytes, (refer_feature, refer_output) = saved_tensor_bytes(forward, refer_input)
+    total = path_gradients(refer_output, refer_feature, classes)
+    refer_feature = refer_feature.detach()
+    chunk = chunk_points(memory_budget, point_bytes, classes)
+
+    alphas = torch.arange(1, step + 1, dtype=input.dtype, device=input.device) / step
+    path_total, feature, output = sum_path_gradients(forward, input, refer_input, alphas, classes, chunk)
+    total = total + path_total
+
+    if classes is None:
+        delta = (output - refer_output.detach()).view(-1)
+    else:
+        classes = torch.as_tensor(classes, dtype=torch.long, device=output.device)
+        delta = (output - refer_output.detach())[0, classes]
+    scale = torch.clamp(torch.abs(delta), min=1e-12)
+
+    attribution = summed_attribution(total / (step + 1), feature, refer_feature)
+    while step < max_step:
+        midpoints = (2 * torch.arange(step, dtype=input.dtype, device=input.device) + 1) / (2 * step)
+        total = total + sum_path_gradients(forward, input, refer_input, midpoints, classes, chunk)[0]
+        step = 2 * step
+
+        previous, attribution = attribution, summed_attribution(total / (step + 1), feature, refer_feature)
+        if torch.max(torch.abs(attribution - previous) / scale) < tolerance:
+            break
+
+    return total / (step + 1), feature, refer_feature, step
+
+
+def location_hessian_quadratic(output, feature, chunk=None):
+    """Per-location second-order term a_l^T H_l a_l of a scalar output.
+
+    H_l is the C x C Hessian block of output w.r.t. the channels of feature at
+    spatial location l and a_l the activation there. Instead of building H_l
+    row by row, one Hessian-vector product is taken per location with the
+    direction v_l = feature masked to l, so that (H v_l) at l dotted with a_l
+    is the quadratic term. The directions are batched over the graph of the
+    first-order gradient, chunk locations per pass (all by default).
+
+    output:  scalar (or single element) output
+    feature: (1, C, H, W) activation recorded on the graph of output
+    returns (first-order gradient (C, H, W), quadratic term (H, W))
+    """
+    grad_feature = torch.autograd.grad(torch.sum(output), feature, create_graph=True)[0]
+    activation = feature.detach()[0]
+    height, width = activation.shape[-2:]
+    locations = height * width
+    chunk = locations if chunk is None else chunk
+
+    masks = torch.eye(locations, dtype=activation.dtype, device=activation.device).view(locations, 1, height, width)
+    quadratic = activation.new_zeros(locations)
+    for start in range(0, locations, chunk):
+        directions = (masks[start:start + chunk] * activation).unsqueeze(1)
+        hessian_vector = torch.autograd.grad(grad_feature, feature, grad_outputs=directions,
+                                             retain_graph=True, is_grads_batched=True)[0]
+        quadratic[start:start + chunk] = torch.sum(hessian_vector * directions, dim=(1, 2, 3, 4))
+    return grad_feature.detach()[0], quadratic.view(height, width)
+
+
+def hutchinson_location_quadratic(output, feature, probes=16, chunk=None):
+    """Stochastic estimate of the per-location term a_l^T H_l a_l.
+
+    Every probe draws Rademacher signs s_l over the locations and takes a
+    single Hessian-vector product with v = sum_l s_l a_l, the activation
+    times the sign map. s_l (H v)_l . a_l then estimates a_l^T H_l a_l without
+    bias, the blocks between different locations only adding zero-mean noise.
+    The probes are batched like the directions of location_hessian_quadratic,
+    chunk probes per pass (all by default).
+
+    returns (first-order gradient (C, H, W), mean estimate (H, W),
+             standard error of the mean (H, W), nan for a single probe)
+    """
+    grad_feature = torch.autograd.grad(torch.sum(output), feature, create_graph=True)[0]
+    activation = feature.detach()[0]
+    chunk = probes if chunk is None else chunk
+
+    estimates = []
+    for start in range(0, probes, chunk):
+        signs = torch.randint(0, 2, (min(chunk, probes - start), 1) + activation.shape[-2:], device=activation.device)
+        directions = ((2 * signs - 1).to(activation.dtype) * activation).unsqueeze(1)
+        hessian_vector = torch.autograd.grad(grad_feature, feature, grad_outputs=directions,
+                                             retain_graph=True, is_grads_batched=True)[0]
+        estimates.append(torch.sum(hessian_vector * directions, dim=(1, 2)))
+    estimates = torch.cat(estimates)
+
+    mean = estimates.mean(dim=0)
+    if probes > 1:
+        stderr = estimates.std(dim=0) / probes ** 0.5
+    else:
+        stderr = torch.full_like(mean, float('nan'))
+    return grad_feature.detach()[0], mean, stderr
+
+
+def find_layer(model, name):
+    """Module of model named name in named_modules(), either exactly or as a
+    dotted suffix, e.g. '42' for 'module.features.42' or 'layer4' for 'module.layer4'."""
+    modules = dict(model.named_modules())
+    if name in modules:
+        return modules[name]
+    matches = [key for key in modules if key.endswith('.' + name)]
+    if len(matches) != 1:
+        raise ValueError("layer '{}' matches {} modules of the model: {}".format(name, len(matches), matches))
+    return modules[matches[0]]
+
+
+class FeatureExtractor():
+    """ Class for extracting activations and registering gradients from
+    targetted intermediate layers of any model, with forward hooks.
+
+    The layers are looked up with find_layer and hooked only for the duration
+    of a call, which runs the model's own forward. Activations are returned in
+    the order of target_layers (the last call of a module reused within the
+    forward wins) and their gradients are collected, in backward order, as the
+    graph is differentiated. With head_only the graph is cut at the first
+    target layer reached. Models returning (output, feature) tuples, like the
+    ResNet here, give their first element. A DataParallel model is run through
+    its module on one device, as its replicas would call the hooks with their
+    own copies of the layers. """
+    def __init__(self, model, target_layers, head_only=False):
+        self.target_layers = [find_layer(model, name) for name in target_layers]
+        if isinstance(model, torch.nn.DataParallel):
+            model = model.module
+        self.model = model
+        self.head_only = head_only
+        self.activations = {}
+        self.gradients = []
+
+    def save_gradient(self, grad):
+        self.gradients.append(grad)
+
+    def save_activation(self, module, input, output):
+        if self.head_only and not self.activations:
+            # cut the graph, backward stops at the target layer
+            output = output.detach().requires_grad_()
+        if output.requires_grad:
+            output.register_hook(self.save_gradient)
+        self.activations[module] = output
+        return output
+
+    def __call__(self, x):
+        self.activations = {}
+        self.gradients = []
+        handles = [layer.register_forward_hook(self.save_activation) for layer in self.target_layers]
+        try:
+            output = self.model(x)
+        finally:
+            for handle in handles:
+                handle.remove()
+        if isinstance(output, tuple):
+            output = output[0]
+        return [self.activations[layer] for layer in self.target_layers], output
+
+
+def smooth_gradcam(forward, input, samples=16, noise_level=0.15, classes=None, positive_gradients=False,
+                   memory_budget=2048):
+    """Grad-CAM maps averaged over noisy copies of input (SmoothGrad).
+
+    The samples copies input + N(0, sigma^2), sigma being noise_level times
+    the value range of input, are stacked along the batch dimension and run
+    through forward in chunks sized to fit memory_budget (MB), judged from
+    the memory the first copy needs for its backward, as integrated_gradients
+    does with its reference point (see chunk_points). Every copy contributes
+    the map of its own activation and gradient; positive_gradients clamps the
+    gradients at zero first, as the hardness heatmaps do.
+
+    forward(x) returns (feature, output) for a batch x of copies
+    returns the averaged maps, (H, W), or (K, H, W) when classes are given
+    """
+    input = input.detach()
+    sigma = noise_level * (input.max() - input.min())
+    noisy = input + sigma * torch.randn((samples,) + input.shape[1:], dtype=input.dtype, device=input.device)
+
+    def summed_maps(feature, output):
+        if classes is None:
+            gradients = torch.autograd.grad(torch.sum(output), feature)[0]
+        else:
+            gradients = batched_class_gradients(output, feature, classes)
+        if positive_gradients:
+            gradients = torch.clamp(gradients, min=0.0)
+        return gradcam_maps(feature, gradients).sum(dim=-3)
+
+    point_bytes, (feature, output) = saved_tensor_bytes(forward, noisy[:1])
+    total = summed_maps(feature, output)
+    chunk = chunk_points(memory_budget, point_bytes, classes)
+
+    for start in range(1, samples, chunk):
+        total = total + summed_maps(*forward(noisy[start:start + chunk]))
+    return total / samples
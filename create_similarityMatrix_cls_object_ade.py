@@ -1,5 +1,6 @@
 import numpy as np
-from scipy import misc
+from datasets import default_flist_reader
+from eval_cache import presence_matrix, save_common_attributes
 
 def softmax(x):
     ex = np.exp(x)
@@ -7,74 +8,107 @@ def softmax(x):
     return ex/sum_ex
 
 ADE_gt_tr = './ade/ADEChallengeData2016/ADE_gt_tr.txt'
-img_path_list_tr = []
-img_label_list_tr = []
-with open(ADE_gt_tr, 'r') as rf:
-    for line in rf.readlines():
-        img_name, img_label, img_index = line.strip().split()
-        img_name = img_name[:27] + "annotations" + img_name[33:-3] + "png"
-        img_path_list_tr.append(img_name)
-        img_label_list_tr.append(int(img_label))
+img_label_list_tr = np.array([img_label for _, img_label, _ in default_flist_reader(ADE_gt_tr)], dtype=int)
 
+# (images, objects) presence of every object in every training annotation, each decoded once
+object_presence_tr = presence_matrix(ADE_gt_tr, './ade/ADE_object_presence_tr.npy')
+
+# frequency of every object among the images of every class, classes without images left at zero
 Class_num = 1040
 all_cls_attributes_info = np.zeros((Class_num, 150))
-img_label_list_tr = np.array(img_label_list_tr)
-for i_cls in range(Class_num):
-    print(i_cls)
-    idx = np.where(img_label_list_tr == i_cls)[0]
-    cur_img_path_list_tr = [img_path_list_tr[i] for i in idx]
-    cls_attributes_info = np.zeros((len(cur_img_path_list_tr), 150))
-
-    if len(cur_img_path_list_tr) > 0:
-        for i_img in range(len(cur_img_path_list_tr)):
-            image = misc.imread(cur_img_path_list_tr[i_img])
-            image = image.flatten().tolist()
-            objectList = list(set(image))
-            objectList.sort()
-            objectList = np.array(objectList)
-            objectList = objectList[objectList != 0]
-            cls_attributes_info[i_img, objectList-1] = 1
-        cls_attributes_info = np.sum(cls_attributes_info, axis=0) / len(cur_img_path_list_tr)
-        # cls_attributes_info = softmax(cls_attributes_info)
-        all_cls_attributes_info[i_cls, :] = cls_attributes_info
+np.add.at(all_cls_attributes_info, img_label_list_tr, object_presence_tr)
+num_imgs_cls = np.bincount(img_label_list_tr, minlength=Class_num)
+all_cls_attributes_info[num_imgs_cls > 0] /= num_imgs_cls[num_imgs_cls > 0, None]
+# all_cls_attributes_info = softmax(all_cls_attributes_info)
 
 # np.save('./ade/all_cls_attributes_info.npy', all_cls_attributes_info)
 # all_cls_attributes_info = np.load('./ade/all_cls_attributes_info.npy')
 
 
-def compute_ClsSimilarity_underObject(class_attributes):
-    ClsSimilarity_underObject = np.zeros((1040, 1040))
-    for i in range(1040):
-        for j in range(i+1, 1040):
-            if class_attributes[i] > 0 and class_attributes[j] > 0:
-                ClsSimilarity_underObject[i, j] = (class_attributes[i] + class_attributes[j]) / 2.0
-                ClsSimilarity_underObject[j, i] = ClsSimilarity_underObject[i, j]
-    return ClsSimilarity_underObject
+# The similarity of two classes under an object is the mean of their frequencies of the object
+# when both are nonzero, and zero otherwise (and on the diagonal). Only the classes with a nonzero
+# frequency take part, so the class x class x object tensor is never built: each object keeps
+# the sorted frequencies of its classes and the similarities of their pairs are evaluated in
+# blocks of rows when needed.
+
+def active_classes(class_attributes):
+    """Classes with a nonzero frequency of an object and their frequencies, by increasing frequency."""
+    classes = np.flatnonzero(class_attributes)
+    classes = classes[np.argsort(class_attributes[classes], kind='stable')]
+    return classes, class_attributes[classes]
+
+
+def pair_similarity_blocks(frequencies, chunk=256):
+    """(rows, upper, similarities) blocks of at most chunk rows of the similarities
+    (f_i + f_j) / 2.0 of all pairs of frequencies, upper marking the pairs i < j."""
+    n = len(frequencies)
+    for start in range(0, n, chunk):
+        rows = np.arange(start, min(start + chunk, n))
+        upper = np.arange(n)[None, :] > rows[:, None]
+        yield rows, upper, (frequencies[rows, None] + frequencies[None, :]) / 2.0
+
+
+def pair_similarity_quantile(object_frequencies, rank, budget=1 << 20):
+    """rank-th smallest (from 0) similarity of the class pairs i < j of all objects.
+
+    Bisects the similarity range on counts of the pairs at or below a value until at
+    most budget pairs are left in it, and selects among those; when a value is shared
+    by more pairs than that, the bisection closes in on it instead.
+    """
+    def count_le(value):
+        return sum(int(np.count_nonzero(upper & (similarities <= value)))
+                   for frequencies in object_frequencies
+                   for _, upper, similarities in pair_similarity_blocks(frequencies))
+
+    lo, count_lo = 0.0, 0
+    hi = max(float(frequencies[-1]) for frequencies in object_frequencies if len(frequencies) > 0)
+    count_hi = sum(len(frequencies) * (len(frequencies) - 1) // 2 for frequencies in object_frequencies)
+    while count_hi - count_lo > budget:
+        mid = (lo + hi) / 2.0
+        if mid <= lo or mid >= hi:
+            return hi
+        count_mid = count_le(mid)
+        if count_mid > rank:
+            hi, count_hi = mid, count_mid
+        else:
+            lo, count_lo = mid, count_mid
+    similarities = np.concatenate([s[upper & (s > lo) & (s <= hi)]
+                                   for frequencies in object_frequencies
+                                   for _, upper, s in pair_similarity_blocks(frequencies)])
+    return np.partition(similarities, rank - count_lo)[rank - count_lo]
+
 
 Object_num = 150
 all_cls_attributes_info[all_cls_attributes_info < 0.3] = 0
-similarityMatrix_cls_part = np.zeros((Class_num, Class_num, Object_num))
-for i_obj in range(Object_num):
-    print(i_obj)
-    similarityMatrix_cls_part[:, :, i_obj] = compute_ClsSimilarity_underObject(all_cls_attributes_info[:, i_obj])
-
-# np.save('./ade/similarityMatrix_cls_part.npy', similarityMatrix_cls_part)
-# similarityMatrix_cls_part = np.load('./ade/similarityMatrix_cls_part.npy')
+object_classes, object_frequencies = zip(*[active_classes(all_cls_attributes_info[:, i_obj]) for i_obj in range(Object_num)])
 
-# threshold and remain most similar parts between each class pair
-threshold = np.sort(similarityMatrix_cls_part.flatten())[int(0.99*Class_num*Class_num*Object_num)]
-similarityMatrix_cls_part_copy = np.copy(similarityMatrix_cls_part)
-similarityMatrix_cls_part_copy[similarityMatrix_cls_part >= threshold] = 1
-similarityMatrix_cls_part_copy[similarityMatrix_cls_part < threshold] = 0
-similarityMatrix_cls_part_copy = similarityMatrix_cls_part_copy.astype(int)
+# threshold at the 99th percentile of the similarities of all class x class x object entries,
+# where every pair i < j of an object appears twice and every other entry is a zero
+num_entries = Class_num * Class_num * Object_num
+num_pairs = sum(len(frequencies) * (len(frequencies) - 1) // 2 for frequencies in object_frequencies)
+rank = int(0.99 * num_entries) - (num_entries - 2 * num_pairs)
+if rank < 0:
+    # the percentile falls on the zeros, which every entry reaches
+    threshold = 0.0
+else:
+    threshold = pair_similarity_quantile(object_frequencies, rank // 2)
+print('threshold', threshold)
 
+# remain the objects most similar between each class pair
+common_objects = {}
+if threshold > 0:
+    for i_obj in range(Object_num):
+        classes = object_classes[i_obj]
+        for rows, upper, similarities in pair_similarity_blocks(object_frequencies[i_obj]):
+            i_row, i_col = np.nonzero(upper & (similarities >= threshold))
+            for i, j in zip(classes[rows[i_row]], classes[i_col]):
+                common_objects.setdefault((min(i, j), max(i, j)), []).append(i_obj + 1)
 
 com_extracted_attributes = np.zeros((Class_num, Class_num), dtype=object)
 for i in range(Class_num):
     for j in range(i+1, Class_num):
-        object_idx = np.argwhere(similarityMatrix_cls_part_copy[i, j, :] == 1).flatten()
-        object_idx = object_idx + 1
-        object_idx = object_idx.tolist()
+        object_idx = list(range(1, Object_num + 1)) if threshold == 0 else common_objects.get((i, j), [])
         com_extracted_attributes[i, j] = object_idx
         com_extracted_attributes[j, i] = object_idx
-np.save('./ade/com_extracted_attributes_001.npy', com_extracted_attributes)
\ No newline at end of file
+np.save('./ade/com_extracted_attributes_001.npy', com_extracted_attributes)
+save_common_attributes(com_extracted_attributes, './ade/com_extracted_attributes_001')
\ No newline at end of file
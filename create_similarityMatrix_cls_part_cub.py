@@ -1,23 +1,27 @@
 import numpy as np
 from scipy._lib._util import _asarray_validated
 from scipy.stats import entropy
+from eval_cache import save_common_attributes
 
 
-def compute_ClsSimilarity_underPart(class_attributes, part_type):
-    ClsSimilarity_underPart = np.zeros((200, 200))
+def compute_ClsSimilarity_underPart(class_attributes, part_type, chunk=64):
+    num_classes = len(class_attributes[0])
+    ClsSimilarity_underPart = np.zeros((num_classes, num_classes))
     for i_p in range(part_type):
         part_attributes = softmax(class_attributes[i_p], axis=1)
-        for i in range(200):
-            for j in range(i+1, 200):
-                ClsSimilarity_underPart[i, j] = ClsSimilarity_underPart[i, j] + Dominik2003IT(part_attributes[i], part_attributes[j])
-                ClsSimilarity_underPart[j, i] = ClsSimilarity_underPart[i, j]
+        # divergences of chunk classes against all classes in one broadcast, (chunk, classes, attributes)
+        # at a time; the divergence is symmetric and zero on the diagonal, so the full matrix is the
+        # one the pairs i < j give
+        for i in range(0, num_classes, chunk):
+            ClsSimilarity_underPart[i:i + chunk] += Dominik2003IT(part_attributes[i:i + chunk, None, :], part_attributes[None, :, :])
     return ClsSimilarity_underPart / part_type
 
 
 def Dominik2003IT(distribution1, distribution2):
+    """Divergence of the distributions along the last axis, broadcast over the others."""
     term1 = distribution1 * np.log((2.0 * distribution1) / (distribution1 + distribution2))
     term2 = distribution2 * np.log((2.0 * distribution2) / (distribution1 + distribution2))
-    return np.sum(term1 + term2)
+    return np.sum(term1 + term2, axis=-1)
 
 def logsumexp(a, axis=None, b=None, keepdims=False, return_sign=False):
 
@@ -131,4 +135,5 @@ for i in range(class_num):
         part_idx = part_idx.tolist()
         com_extracted_attributes[i, j] = part_idx
         com_extracted_attributes[j, i] = part_idx
-np.save('./cub200/Dominik2003IT_com_extracted_attributes_02.npy', com_extracted_attributes)
\ No newline at end of file
+np.save('./cub200/Dominik2003IT_com_extracted_attributes_02.npy', com_extracted_attributes)
+save_common_attributes(com_extracted_attributes, './cub200/Dominik2003IT_com_extracted_attributes_02')
\ No newline at end of file
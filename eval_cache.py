@@ -0,0 +1,365 @@
+import os
+import json
+import shutil
+import argparse
+import functools
+import multiprocessing
+import numpy as np
+from PIL import Image
+from datasets import default_flist_reader
+
+
+# EXIF orientations under which a decoder returns the image transposed
+_TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+
+
+def annotation_path(impath):
+    """Path of the ADE annotation png of an image path of the file lists."""
+    return impath[:27] + "annotations" + impath[33:-3] + "png"
+
+
+def load_segmentation(path, size=256, crop=224):
+    """Label map of an annotation in the geometry of the evaluation crop.
+
+    The same Resize(size) and CenterCrop(crop) as the validation transform,
+    with nearest-neighbour resampling so labels are never blended.
+    """
+    seg = Image.open(path)
+    width, height = seg.size
+    if width < height:
+        width, height = size, int(size * height / width)
+    else:
+        width, height = int(size * width / height), size
+    seg = seg.resize((width, height), Image.NEAREST)
+    left = int(round((width - crop) / 2.0))
+    top = int(round((height - crop) / 2.0))
+    seg = seg.crop((left, top, left + crop, top + crop))
+    return np.asarray(seg, dtype=np.uint8)
+
+
+def build_segmentation_cache(flist, cache_path, size=256, crop=224):
+    """Decode the annotation of every image of flist once into a single uint8
+    (N, crop, crop) .npy array, row i holding the i-th line of flist."""
+    imlist = default_flist_reader(flist)
+    cache = np.lib.format.open_memmap(cache_path + '.tmp', mode='w+', dtype=np.uint8, shape=(len(imlist), crop, crop))
+    for i, (impath, _, _) in enumerate(imlist):
+        cache[i] = load_segmentation(annotation_path(impath), size, crop)
+    cache.flush()
+    del cache
+    os.rename(cache_path + '.tmp', cache_path)
+
+
+def segmentation_cache(flist, cache_path, size=256, crop=224):
+    """Memory-mapped label maps of flist, building the cache on first use."""
+    if not os.path.isfile(cache_path):
+        print("=> building segmentation cache '{}'".format(cache_path))
+        build_segmentation_cache(flist, cache_path, size, crop)
+    return np.load(cache_path, mmap_mode='r')
+
+
+def object_presence(path, num_objects=150):
+    """(num_objects,) bool presence of the objects 1..num_objects in an ADE annotation."""
+    with Image.open(path) as seg:
+        counts = np.bincount(np.asarray(seg).ravel(), minlength=num_objects + 1)
+    return counts[1:num_objects + 1] > 0
+
+
+def build_presence_matrix(flist, matrix_path, num_objects=150, workers=4):
+    """Decode the annotation of every image of flist once, in a process pool,
+    into a bool (N, num_objects) object presence .npy array, row i holding the
+    i-th line of flist."""
+    annotations = [annotation_path(impath) for impath, _, _ in default_flist_reader(flist)]
+    presence = np.lib.format.open_memmap(matrix_path + '.tmp', mode='w+', dtype=bool, shape=(len(annotations), num_objects))
+    pool = multiprocessing.Pool(workers)
+    try:
+        for i, row in enumerate(pool.imap(functools.partial(object_presence, num_objects=num_objects), annotations, chunksize=16)):
+            presence[i] = row
+    finally:
+        pool.close()
+        pool.join()
+    presence.flush()
+    del presence
+    os.rename(matrix_path + '.tmp', matrix_path)
+
+
+def presence_matrix(flist, matrix_path, num_objects=150, workers=4):
+    """Object presence in the annotations of flist, building the matrix on first use."""
+    if not os.path.isfile(matrix_path):
+        print("=> building object presence matrix '{}'".format(matrix_path))
+        build_presence_matrix(flist, matrix_path, num_objects, workers)
+    return np.load(matrix_path)
+
+
+def image_size(path):
+    """(height, width) of an image as cv2.imread would decode it, read from the
+    file header only (EXIF-rotated images are reported transposed)."""
+    with Image.open(path) as img:
+        width, height = img.size
+        if img.getexif().get(0x0112, 1) in _TRANSPOSED_ORIENTATIONS:
+            width, height = height, width
+    return height, width
+
+
+def build_size_index(flist, index_path, workers=4):
+    """Store the (height, width) of every image of flist as an int32 (N, 2)
+    .npy array, row i holding the i-th line of flist."""
+    imlist = [impath for impath, _, _ in default_flist_reader(flist)]
+    pool = multiprocessing.Pool(workers)
+    try:
+        sizes = pool.map(image_size, imlist, chunksize=64)
+    finally:
+        pool.close()
+        pool.join()
+    with open(index_path + '.tmp', 'wb') as f:
+        np.save(f, np.array(sizes, dtype=np.int32).reshape(-1, 2))
+    os.rename(index_path + '.tmp', index_path)
+
+
+def size_index(flist, index_path, workers=4):
+    """(height, width) of every image of flist, building the index on first use."""
+    if not os.path.isfile(index_path):
+        print("=> building image size index '{}'".format(index_path))
+        build_size_index(flist, index_path, workers)
+    return np.load(index_path)
+
+
+def read_part_locations(cub_root, num_parts=15, train=False):
+    """(N, num_parts, 2) int16 (x, y) part locations, rounded, and (N, num_parts)
+    bool visibility of the test (or training) images of CUB, in the order of
+    images.txt, parsed from parts/part_locs.txt in one pass. Invisible parts
+    are at (0, 0) as the dataset gives them."""
+    with open(os.path.join(cub_root, 'parts', 'part_locs.txt'), 'r') as f:
+        rows = np.array(f.read().split(), dtype=np.float64).reshape(-1, 5)
+    with open(os.path.join(cub_root, 'train_test_split.txt'), 'r') as f:
+        split = np.array(f.read().split(), dtype=np.int64).reshape(-1, 2)
+    is_train = np.zeros(int(split[:, 0].max()), dtype=bool)
+    is_train[split[:, 0] - 1] = split[:, 1] == 1
+    # rows of <image id> <part id> <x> <y> <visible>
+    image = rows[:, 0].astype(np.int64) - 1
+    part = rows[:, 1].astype(np.int64) - 1
+    locations = np.zeros((len(is_train), num_parts, 2), dtype=np.int16)
+    visible = np.zeros((len(is_train), num_parts), dtype=bool)
+    given = np.zeros((len(is_train), num_parts), dtype=bool)
+    locations[image, part] = np.rint(rows[:, 2:4])
+    visible[image, part] = rows[:, 4] > 0
+    given[image, part] = True
+    if not given.all():
+        raise ValueError("'{}' lacks {} part locations".format(cub_root, int((~given).sum())))
+    keep = is_train if train else ~is_train
+    return locations[keep], visible[keep]
+
+
+def build_part_locations(cub_root, store_path, num_parts=15, train=False):
+    """Write the read_part_locations of CUB as locations.npy and visible.npy
+    under store_path, replacing a store already there."""
+    locations, visible = read_part_locations(cub_root, num_parts, train)
+    tmp_path = store_path + '.tmp'
+    if not os.path.isdir(tmp_path):
+        os.makedirs(tmp_path)
+    np.save(os.path.join(tmp_path, 'locations.npy'), locations)
+    np.save(os.path.join(tmp_path, 'visible.npy'), visible)
+    if os.path.isdir(store_path):
+        shutil.rmtree(store_path)
+    os.rename(tmp_path, store_path)
+
+
+def part_locations(store_path, cub_root='./cub200/CUB_200_2011', mmap_mode='r'):
+    """Memory-mapped (N, parts, 2) part locations and (N, parts) visibility of
+    the CUB test images, building the store on first use."""
+    if not os.path.isfile(os.path.join(store_path, 'visible.npy')):
+        print("=> building part location store '{}'".format(store_path))
+        build_part_locations(cub_root, store_path)
+    return (np.load(os.path.join(store_path, 'locations.npy'), mmap_mode=mmap_mode),
+            np.load(os.path.join(store_path, 'visible.npy'), mmap_mode=mmap_mode))
+
+
+def save_common_attributes(com_extracted_attributes, store_path):
+    """Write the common attributes of a (C, C) com_extracted_attributes object
+    array of lists as a CommonAttributeStore directory: the attribute ids of
+    every pair, row-major, in one int16 array and the (C * C + 1,) offsets of
+    the pairs into it. Entries that are not lists (the diagonal) have none.
+    A store already at store_path is replaced."""
+    num_classes = com_extracted_attributes.shape[0]
+    offsets = np.zeros(num_classes * num_classes + 1, dtype=np.int64)
+    attributes = []
+    for row, entry in enumerate(com_extracted_attributes.flat):
+        entry = np.asarray(entry, dtype=np.int16).ravel() if isinstance(entry, (list, tuple, np.ndarray)) else np.zeros(0, dtype=np.int16)
+        attributes.append(entry)
+        offsets[row + 1] = offsets[row] + len(entry)
+    attributes = np.concatenate(attributes) if attributes else np.zeros(0, dtype=np.int16)
+    tmp_path = store_path + '.tmp'
+    if not os.path.isdir(tmp_path):
+        os.makedirs(tmp_path)
+    np.save(os.path.join(tmp_path, 'offsets.npy'), offsets)
+    np.save(os.path.join(tmp_path, 'attributes.npy'), attributes)
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump({'num_classes': int(num_classes),
+                   'num_attributes': int(attributes.max()) + 1 if len(attributes) > 0 else 0}, f)
+    if os.path.isdir(store_path):
+        shutil.rmtree(store_path)
+    os.rename(tmp_path, store_path)
+
+
+class CommonAttributeStore(object):
+    """Common attributes of every class pair in CSR form, memory-mapped from
+    the directory save_common_attributes wrote.
+
+    store[a, b] is the slice of the attribute ids of the pair (a, b), as
+    com_extracted_attributes[a, b] held them; lookup() and masks() answer
+    for arrays of pairs at once. num_attributes is one past the largest id.
+    """
+    def __init__(self, path, mmap_mode='r'):
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        self.num_classes = meta['num_classes']
+        self.num_attributes = meta['num_attributes']
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'), mmap_mode=mmap_mode)
+        self.attributes = np.load(os.path.join(path, 'attributes.npy'), mmap_mode=mmap_mode)
+
+    def __getitem__(self, key):
+        row = int(key[0]) * self.num_classes + int(key[1])
+        return self.attributes[self.offsets[row]:self.offsets[row + 1]]
+
+    def _gather(self, a, b):
+        """(P,) counts of the pairs (a[i], b[i]) and the positions of their ids,
+        concatenated."""
+        rows = np.asarray(a, dtype=np.int64) * self.num_classes + np.asarray(b, dtype=np.int64)
+        starts = self.offsets[rows]
+        counts = self.offsets[rows + 1] - starts
+        # starts[i] + 0 .. counts[i] - 1 for every pair, without a Python loop
+        positions = np.arange(counts.sum()) + np.repeat(starts - np.cumsum(counts) + counts, counts)
+        return counts, positions
+
+    def counts(self, a, b):
+        """(P,) number of common attributes of the pairs (a[i], b[i])."""
+        rows = np.asarray(a, dtype=np.int64) * self.num_classes + np.asarray(b, dtype=np.int64)
+        return self.offsets[rows + 1] - self.offsets[rows]
+
+    def lookup(self, a, b):
+        """Common attribute ids of the pairs (a[i], b[i]), a list of int arrays."""
+        counts, positions = self._gather(a, b)
+        if len(counts) == 0:
+            return []
+        return np.split(self.attributes[positions].astype(int), np.cumsum(counts)[:-1])
+
+    def masks(self, a, b, width=None):
+        """(P, width) bool masks of the common attributes of the pairs (a[i], b[i]),
+        width defaulting to num_attributes."""
+        counts, positions = self._gather(a, b)
+        masks = np.zeros((len(counts), self.num_attributes if width is None else width), dtype=bool)
+        masks[np.repeat(np.arange(len(counts)), counts), self.attributes[positions]] = True
+        return masks
+
+
+def common_attribute_store(npy_path, store_path):
+    """CommonAttributeStore of the com_extracted_attributes array saved at
+    npy_path, converting it on first use."""
+    if not os.path.isfile(os.path.join(store_path, 'meta.json')):
+        print("=> building common attribute store '{}'".format(store_path))
+        save_common_attributes(np.load(npy_path, allow_pickle=True), store_path)
+    return CommonAttributeStore(store_path)
+
+
+class ResultStore(object):
+    """Per-example scores of an evaluation, kept in .npy memmaps under path so
+    that a run can be resumed and its curves read while it runs.
+
+    Every array of names has the given shape, one (Q,) row per example index
+    (all axes but the last), and starts as nan, so its nanmean over the
+    examples only counts the rows written so far. row_shapes gives the arrays
+    whose rows are of another shape than (Q,), e.g. a map per example. done
+    marks the rows committed, flushed after them; a restart skips those.
+    config is stored with the arrays and a store of another configuration is
+    refused. Without a path the arrays are kept in memory only.
+    """
+    def __init__(self, path, names, shape, config=None, row_shapes=None):
+        self.path = path
+        shape = tuple(int(n) for n in shape)
+        row_shapes = dict((name, tuple(int(n) for n in row_shape)) for name, row_shape in (row_shapes or {}).items())
+        shapes = dict((name, shape[:-1] + row_shapes.get(name, shape[-1:])) for name in names)
+        if path is None:
+            self.arrays = {name: np.full(shapes[name], np.nan) for name in names}
+            self.done = np.zeros(shape[:-1], dtype=bool)
+            return
+        config = dict(config or {}, names=list(names), shape=list(shape))
+        if row_shapes:
+            config['row_shapes'] = dict((name, list(row_shape)) for name, row_shape in row_shapes.items())
+        meta_path = os.path.join(path, 'meta.json')
+        resume = os.path.isfile(meta_path)
+        if resume:
+            with open(meta_path, 'r') as f:
+                stored = json.load(f)
+            if stored != config:
+                raise ValueError("results in '{}' were computed with {}, not {}".format(path, stored, config))
+        elif not os.path.isdir(path):
+            os.makedirs(path)
+        mode = 'r+' if resume else 'w+'
+        self.arrays = {}
+        for name in names:
+            self.arrays[name] = np.lib.format.open_memmap(os.path.join(path, name + '.npy'), mode=mode, dtype=np.float64, shape=shapes[name])
+        self.done = np.lib.format.open_memmap(os.path.join(path, 'done.npy'), mode=mode, dtype=bool, shape=shape[:-1])
+        if resume:
+            print("=> resuming '{}' with {} of {} rows done".format(path, int(self.done.sum()), self.done.size))
+        else:
+            for array in self.arrays.values():
+                array[:] = np.nan
+                array.flush()
+            self.done.flush()
+            # written last: a store whose creation was interrupted is created again
+            with open(meta_path, 'w') as f:
+                json.dump(config, f)
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def commit(self, index):
+        """Mark the rows of index as written, once they are on disk."""
+        if self.path is not None:
+            for array in self.arrays.values():
+                array.flush()
+        self.done[index] = True
+        if self.path is not None:
+            self.done.flush()
+
+
+def result_curves(path):
+    """nanmean over the examples of every array of the ResultStore at path, as
+    far as it got, and the number of examples done (per leading index)."""
+    with open(os.path.join(path, 'meta.json'), 'r') as f:
+        meta = json.load(f)
+    # the examples are the last axis of the row index
+    example_axis = len(meta['shape']) - 2
+    curves = {}
+    for name in meta['names']:
+        curves[name] = np.nanmean(np.load(os.path.join(path, name + '.npy'), mmap_mode='r'), axis=example_axis)
+    return curves, np.load(os.path.join(path, 'done.npy'), mmap_mode='r').sum(axis=-1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the evaluation caches')
+    parser.add_argument('kind', nargs='?', default='segmentation', choices=['segmentation', 'sizes', 'parts', 'objects', 'attributes', 'results'],
+                        help='ADE segmentation label cache, CUB image size index, CUB part location store, ADE object '
+                             'presence matrix or common attribute store to build, or the curves of a result directory '
+                             'to print (default: segmentation)')
+    parser.add_argument('--flist', default=None, help='image file list to cache (the CUB_200_2011 directory for parts, '
+                                                      'the com_extracted_attributes .npy for attributes)')
+    parser.add_argument('--cache', default=None, help='path of the cache to write, or of the result directory')
+    parser.add_argument('-j', '--workers', default=4, type=int, metavar='N', help='processes reading the images (default: 4)')
+    args = parser.parse_args()
+    if args.kind == 'results':
+        curves, done = result_curves(args.cache)
+        print('examples done', done)
+        for name, curve in sorted(curves.items()):
+            print(name)
+            print(curve)
+    elif args.kind == 'segmentation':
+        build_segmentation_cache(args.flist or './ade/ADE_gt_val.txt', args.cache or './ade/ADE_seg_val_224.npy')
+    elif args.kind == 'parts':
+        build_part_locations(args.flist or './cub200/CUB_200_2011', args.cache or './cub200/CUB200_partLocs_te')
+    elif args.kind == 'attributes':
+        save_common_attributes(np.load(args.flist, allow_pickle=True), args.cache or os.path.splitext(args.flist)[0])
+    elif args.kind == 'objects':
+        build_presence_matrix(args.flist or './ade/ADEChallengeData2016/ADE_gt_tr.txt', args.cache or './ade/ADE_object_presence_tr.npy',
+                              workers=args.workers)
+    else:
+        build_size_index(args.flist or './cub200/CUB200_gt_te.txt', args.cache or './cub200/CUB200_sizes_te.npy', args.workers)
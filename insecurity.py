@@ -0,0 +1,528 @@
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+def confusion_atoms(classifier_heatmaps, topKcls):
+    """Unique (i, j), i < j, pairs of top-K class positions that rank among the
+    topKcls largest class heatmaps at some pixel.
+
+    classifier_heatmaps: (H, W, K) array
+    returns: (A, 2) int array
+    """
+    classifier_heatmaps = np.asarray(classifier_heatmaps)
+    confusion_classes = np.argsort(classifier_heatmaps, axis=2, kind='stable')[:, :, -topKcls:]
+    confusion_classes = np.sort(confusion_classes, axis=2).reshape(-1, topKcls)
+    i_cls, j_cls = np.triu_indices(topKcls, k=1)
+    pairs = np.stack((confusion_classes[:, i_cls], confusion_classes[:, j_cls]), axis=2).reshape(-1, 2)
+    pairs = np.unique(pairs, axis=0)
+    return pairs[~np.all(pairs == 0, axis=1)].astype(int)
+
+
+def common_attribute_masks(com_extracted_attributes, topK_classes, atoms, width=None):
+    """(A, width) bool masks of the common attributes of the two predicted
+    classes of every atom, from a CommonAttributeStore."""
+    atoms = np.asarray(atoms, dtype=int).reshape(-1, 2)
+    return com_extracted_attributes.masks(topK_classes[atoms[:, 0]], topK_classes[atoms[:, 1]], width)
+
+
+def attributed_atoms(atoms, com_masks):
+    """The atoms that have common attributes and their masks, and the number
+    of the others, whose scores do not depend on their maps."""
+    keep = com_masks.any(axis=1)
+    return atoms[keep], com_masks[keep], len(atoms) - int(keep.sum())
+
+
+def pad_atom_scores(atom_scores, num_atoms, fill):
+    """(A, Q) atom_scores followed by num_atoms rows of fill."""
+    padding = torch.full((num_atoms, atom_scores.shape[1]), fill, dtype=atom_scores.dtype, device=atom_scores.device)
+    return torch.cat((atom_scores, padding))
+
+
+class ConfusionMeter(object):
+    """Streams the confusion matrix and the top-K co-ranking of the classes
+    over a validation pass.
+
+    Every batch adds its (target, prediction) pairs and the unordered pairs of
+    classes ranking together among the topK of an example to dense (C, C)
+    counts with one bincount each; the pairs counted at least once are the
+    only ones the insecurity of the validated examples can look up, and
+    they are ranked by how often one class is mistaken for the other.
+    """
+    def __init__(self, num_classes, topK=5):
+        self.num_classes = num_classes
+        self.topK = topK
+        self.confusion = torch.zeros(num_classes * num_classes, dtype=torch.long)
+        self.coranking = torch.zeros(num_classes * num_classes, dtype=torch.long)
+        self.classes = []
+        self.probs = []
+
+    def update(self, class_dis, target):
+        """class_dis: (B, C) class probabilities, target: (B,) labels"""
+        class_dis = torch.as_tensor(class_dis).detach()
+        target = torch.as_tensor(target, device=class_dis.device).long()
+        probs, classes = torch.topk(class_dis, self.topK, dim=1)
+        n = self.num_classes
+        self.confusion += torch.bincount((target * n + classes[:, 0]).cpu(), minlength=n * n)
+        i_cls, j_cls = np.triu_indices(self.topK, k=1)
+        a, b = classes[:, i_cls], classes[:, j_cls]
+        self.coranking += torch.bincount((torch.min(a, b) * n + torch.max(a, b)).flatten().cpu(), minlength=n * n)
+        self.classes.append(classes.cpu().numpy())
+        self.probs.append(probs.cpu().numpy())
+
+    def topK_classes(self):
+        """(N, topK) classes of every example by decreasing probability, as
+        largest_indices_each_example gives them, and their probabilities."""
+        return (np.concatenate(self.classes).astype(np.int16) if self.classes else np.zeros((0, self.topK), dtype=np.int16),
+                np.concatenate(self.probs) if self.probs else np.zeros((0, self.topK)))
+
+    def confusion_matrix(self):
+        """(C, C) counts of the examples of every target (row) and prediction."""
+        return self.confusion.view(self.num_classes, self.num_classes).numpy()
+
+    def confusable_pairs(self):
+        """(P, 2) class pairs a < b ranked together at least once, by decreasing
+        number of examples of either predicted as the other, then by
+        decreasing co-ranking, and their (P,) confusion and co-ranking counts."""
+        confusion = self.confusion_matrix()
+        corankings = self.coranking.numpy()
+        pairs = np.flatnonzero(corankings)
+        a, b = pairs // self.num_classes, pairs % self.num_classes
+        confusions = confusion[a, b] + confusion[b, a]
+        order = np.lexsort((-corankings[pairs], -confusions))
+        return np.stack((a, b), axis=1)[order], confusions[order], corankings[pairs][order]
+
+    def save(self, path):
+        """Write the counts and the top-K classes to the .npz file path, read back by load()."""
+        classes, probs = self.topK_classes()
+        np.savez(path, confusion=self.confusion.numpy(), coranking=self.coranking.numpy(), classes=classes, probs=probs)
+
+    @classmethod
+    def load(cls, path):
+        """The meter of a validation pass written by save(), so it need not be run again."""
+        state = np.load(path)
+        meter = cls(int(round(np.sqrt(state['confusion'].size))), state['classes'].shape[1])
+        meter.confusion = torch.from_numpy(state['confusion'])
+        meter.coranking = torch.from_numpy(state['coranking'])
+        meter.classes = [state['classes']]
+        meter.probs = [state['probs']]
+        return meter
+
+    def attributed_examples(self, com_extracted_attributes):
+        """(N,) bool whether any two top-K classes of every example have common
+        attributes in a CommonAttributeStore, looked up once for the
+        confusable pairs. All atoms of the other examples are unattributed,
+        so their scores do not depend on their heatmaps."""
+        pairs = self.confusable_pairs()[0]
+        counts = com_extracted_attributes.counts(pairs[:, 0], pairs[:, 1]) + com_extracted_attributes.counts(pairs[:, 1], pairs[:, 0])
+        attributed = np.zeros((self.num_classes, self.num_classes), dtype=bool)
+        a, b = pairs[counts > 0].T
+        attributed[a, b] = attributed[b, a] = True
+        classes = self.topK_classes()[0].astype(int)
+        i_cls, j_cls = np.triu_indices(self.topK, k=1)
+        return attributed[classes[:, i_cls], classes[:, j_cls]].any(axis=1)
+
+
+def atom_insecurity_maps(difficulty_heatmaps, classifier_heatmaps, atoms, size=224):
+    """Insecurity maps class_a * class_b * difficulty of all atoms, upsampled
+    in one batched bilinear interpolation, or at the heatmap resolution when
+    size is None.
+
+    difficulty_heatmaps: (H, W), classifier_heatmaps: (H, W, K), arrays or tensors
+    returns: (A, size, size) tensor on the device of the heatmaps
+    """
+    difficulty_heatmaps = torch.as_tensor(difficulty_heatmaps)
+    classifier_heatmaps = torch.as_tensor(classifier_heatmaps, device=difficulty_heatmaps.device)
+    atoms = torch.as_tensor(atoms, dtype=torch.long, device=difficulty_heatmaps.device)
+    maps = classifier_heatmaps[:, :, atoms[:, 0]] * classifier_heatmaps[:, :, atoms[:, 1]] * difficulty_heatmaps[:, :, None]
+    maps = maps.permute(2, 0, 1)
+    if size is None:
+        return maps
+    return F.interpolate(maps.unsqueeze(1), size=(size, size), mode='bilinear', align_corners=False)[:, 0]
+
+
+def bilinear_weights(in_size, out_size, dtype=torch.float64, device=None):
+    """(out_size, in_size) matrix of the bilinear upsampling of one axis, as
+    F.interpolate does it with align_corners=False.
+
+    The upsampled maps are separable, weights_y @ map @ weights_x.T, so any
+    pixel of them can be evaluated without building the others.
+    """
+    source = (torch.arange(out_size, dtype=torch.float64, device=device) + 0.5) * in_size / out_size - 0.5
+    source = source.clamp(min=0)
+    low = source.floor().long().clamp(max=in_size - 1)
+    high = (low + 1).clamp(max=in_size - 1)
+    fraction = source - low
+    weights = torch.zeros(out_size, in_size, dtype=torch.float64, device=device)
+    rows = torch.arange(out_size, device=device)
+    weights.index_put_((rows, low), 1 - fraction, accumulate=True)
+    weights.index_put_((rows, high), fraction, accumulate=True)
+    return weights.to(dtype)
+
+
+def area_weights(in_size, out_size, dtype=torch.float64, device=None):
+    """(out_size, in_size) matrix of the overlap of every input pixel with
+    every output cell when in_size pixels are divided into out_size equal
+    cells; rows sum to in_size / out_size and columns to one."""
+    edges = torch.arange(in_size + 1, dtype=torch.float64, device=device)
+    cells = torch.arange(out_size + 1, dtype=torch.float64, device=device) * in_size / out_size
+    overlap = torch.minimum(edges[None, 1:], cells[1:, None]) - torch.maximum(edges[None, :-1], cells[:-1, None])
+    return overlap.clamp(min=0).to(dtype)
+
+
+def sample_insecurity_maps(maps, ys, xs, size=224):
+    """Values of the bilinearly upsampled (A, size, size) maps at pixels (ys, xs),
+    evaluated from the (A, H, W) maps without upsampling them. Returns (A, n)."""
+    weights_y = bilinear_weights(maps.size(1), size, maps.dtype, maps.device)[torch.as_tensor(ys, device=maps.device)]
+    weights_x = bilinear_weights(maps.size(2), size, maps.dtype, maps.device)[torch.as_tensor(xs, device=maps.device)]
+    return torch.einsum('ni,aij,nj->an', weights_y, maps, weights_x)
+
+
+def histogram_thresholds(maps, remaining_mask_size_pool, size=224, bins=4096, chunk=32):
+    """(A, Q) thresholds of mask_thresholds estimated from a histogram of the
+    upsampled maps, built from the (A, H, W) maps a chunk of rows at a time.
+
+    Upsampled values are convex combinations of the map, so the histogram of
+    every atom spans the range of its map; the threshold of a rank is
+    interpolated linearly inside its bin.
+    """
+    device = maps.device
+    num_atoms = maps.size(0)
+    low = maps.flatten(start_dim=1).amin(dim=1, keepdim=True).double()
+    width = (maps.flatten(start_dim=1).amax(dim=1, keepdim=True).double() - low) / bins
+    weights_y = bilinear_weights(maps.size(1), size, maps.dtype, device)
+    weights_x = bilinear_weights(maps.size(2), size, maps.dtype, device)
+
+    counts = torch.zeros(num_atoms, bins, dtype=torch.float64, device=device)
+    for start in range(0, size, chunk):
+        rows = torch.einsum('ri,aij,cj->arc', weights_y[start:start + chunk], maps, weights_x).flatten(start_dim=1)
+        index = ((rows.double() - low) / width.clamp(min=1e-300)).long().clamp(0, bins - 1)
+        counts.scatter_add_(1, index, torch.ones_like(rows, dtype=torch.float64))
+
+    pixels = size * size
+    rank = (-np.asarray(remaining_mask_size_pool) * pixels).astype(int) % pixels
+    rank = torch.as_tensor(rank, dtype=torch.float64, device=device).expand(num_atoms, -1).contiguous()
+    cum_counts = torch.cumsum(counts, dim=1)
+    bin_index = torch.searchsorted(cum_counts, rank + 1).clamp(max=bins - 1)
+    before = torch.gather(cum_counts, 1, bin_index) - torch.gather(counts, 1, bin_index)
+    inside = (rank + 0.5 - before) / torch.gather(counts, 1, bin_index).clamp(min=1)
+    return low + (bin_index + inside) * width
+
+
+def sort_maps(maps):
+    """Ascending order of the pixels of every map, (A, pixels) values and indices."""
+    return torch.sort(maps.flatten(start_dim=1), dim=1)
+
+
+def mask_thresholds(sorted_maps, remaining_mask_size_pool):
+    """(A, Q) thresholds keeping the remaining_mask_size fraction of every map,
+    read off its ascending order for any grid of mask sizes.
+
+    As in the per-pair evaluation, the threshold of fraction q is the element
+    int(-q * pixels) of the ascending order, pixels above it being kept.
+    """
+    pixels = sorted_maps.size(1)
+    index = (-np.asarray(remaining_mask_size_pool) * pixels).astype(int) % pixels
+    return sorted_maps[:, torch.as_tensor(index, device=sorted_maps.device)]
+
+
+def binarize_insecurity(maps, thresholds):
+    """Insecurity masks of maps at broadcastable thresholds.
+
+    Pixels above the threshold become one and the others zero, except values
+    of at least one below the threshold, which keep their value, exactly as
+    the two-step binarization of the per-pair evaluation did.
+    """
+    masks = torch.where(maps < 1, torch.zeros_like(maps), maps)
+    return torch.where(maps > thresholds, torch.ones_like(maps), masks)
+
+
+def masked_sums(sorted_values, weights, thresholds):
+    """Sums of binarize_insecurity(values, t) * weights of every row and threshold.
+
+    The masks of all thresholds are nested in the ascending order of the
+    values, so the sums are differences of cumulative sums located by a
+    binary search, and a grid of Q thresholds costs O(Q log n) on top of
+    the sort.
+
+    sorted_values: (A, n) ascending, weights: (A, n) in the same order,
+    thresholds: (A, Q); returns (A, Q) float64
+    """
+    sorted_values = sorted_values.double().contiguous()
+    weights = weights.double()
+    zero = torch.zeros_like(weights[:, :1])
+    # cumulative weights, and value-weighted cumulative weights for the values
+    # of at least one that stay below the threshold
+    cum_weights = torch.cat((zero, torch.cumsum(weights, dim=1)), dim=1)
+    cum_values = torch.cat((zero, torch.cumsum(sorted_values * weights, dim=1)), dim=1)
+
+    below = torch.searchsorted(sorted_values, thresholds.double().contiguous(), right=True)
+    small = torch.searchsorted(sorted_values, torch.ones_like(zero), right=False).expand_as(below)
+    kept = cum_weights[:, -1:] - torch.gather(cum_weights, 1, below)
+    large = torch.gather(cum_values, 1, torch.maximum(below, small)) - torch.gather(cum_values, 1, small)
+    return kept + large
+
+
+def atom_mean(atom_scores):
+    """Mean over the atoms (axis 0) that have a score, nan when none has."""
+    atom_scores = torch.as_tensor(atom_scores)
+    counted = ~torch.isnan(atom_scores)
+    return (torch.nansum(atom_scores, dim=0) / counted.sum(dim=0)).cpu().numpy()
+
+
+def part_memberships(part_locs, com_masks, size=224):
+    """Visible part positions of an example and their membership in the common
+    parts of every atom.
+
+    part_locs: (parts, 2) int (x, y) positions on the size x size grid, (0, 0)
+    for parts that are not visible. Positions are counted once per pixel.
+    com_masks: (A, parts) bool common parts of every atom.
+    returns: (n, 2) (x, y) unique visible positions, (n,) index of each in the
+    visible parts, (A, n) bool membership, (A,) bool whether the atom has
+    common attributes at all
+    """
+    part_locs = np.asarray(part_locs, dtype=int)
+    visible = part_locs[~np.all(part_locs == 0, axis=1)]
+    positions, first = np.unique(visible[:, 1] * size + visible[:, 0], return_index=True)
+
+    # a position belongs to an atom when any of its common parts lies on it
+    at_position = (part_locs[:, 1] * size + part_locs[:, 0])[:, None] == positions[None, :]
+    membership = np.dot(com_masks.astype(np.int64), at_position.astype(np.int64)) > 0
+    return visible, first, membership, com_masks.any(axis=1)
+
+
+def part_recall_precision(hit, covered, common_size, has_attributes):
+    """Recall and precision from the (A, Q) masked weights of the common and all
+    parts, and the (A, 1) weight of the common parts.
+
+    Atoms without common attributes score a recall of zero; atoms whose
+    common parts are all invisible have no score (nan) and neither have
+    atoms whose mask covers no part for precision.
+    """
+    has_attributes = torch.as_tensor(has_attributes, device=hit.device)
+    nan = torch.full_like(hit, float('nan'))
+    recall = torch.where(common_size > 0, hit / common_size, nan)
+    recall = torch.where(has_attributes[:, None], recall, torch.zeros_like(recall))
+    precision = torch.where((common_size > 0) & (covered > 0), hit / covered, nan)
+    precision = torch.where(has_attributes[:, None], precision, nan)
+    return recall, precision
+
+
+def part_atom_scores(maps, thresholds, part_locs, com_masks, size=None):
+    """Recall and precision of every atom and mask size against part locations.
+
+    part_locs: part positions on the grid of maps and com_masks the common
+    parts of every atom, as in part_memberships. Given a size, maps are
+    the (A, H, W) maps before upsampling, which are only evaluated at the
+    parts.
+
+    returns (recall, precision), (A, Q) tensors
+    """
+    size = size or maps.size(-1)
+    visible, first, membership, has_attributes = part_memberships(part_locs, com_masks, size)
+
+    device = maps.device
+    if size == maps.size(-1):
+        values = maps[:, torch.as_tensor(visible[:, 1], device=device), torch.as_tensor(visible[:, 0], device=device)]
+        values = values[:, torch.as_tensor(first, device=device)]
+    else:
+        if len(visible) > 0 and (visible.min() < 0 or visible.max() >= size):
+            raise IndexError('part location out of the {}x{} grid'.format(size, size))
+        values = sample_insecurity_maps(maps, visible[first, 1], visible[first, 0], size)
+    values, order = torch.sort(values, dim=1)
+
+    membership = torch.gather(torch.as_tensor(membership, device=device, dtype=torch.float64), 1, order)
+    hit = masked_sums(values, membership, thresholds)
+    covered = masked_sums(values, torch.ones_like(membership), thresholds)
+    return part_recall_precision(hit, covered, membership.sum(dim=1, keepdim=True), has_attributes)
+
+
+def native_part_atom_scores(sorted_maps, order, thresholds, shape, part_locs, com_masks, size=224):
+    """part_atom_scores on the (H, W) grid of the maps themselves.
+
+    sorted_maps, order: the ascending order of the (A, H, W) maps from
+    sort_maps. Every part counts for the cells its pixel of the size x size
+    image interpolates from, with the bilinear weights of the upsampling.
+    """
+    visible, first, membership, has_attributes = part_memberships(part_locs, com_masks, size)
+    device = sorted_maps.device
+    weights_y = bilinear_weights(shape[0], size, device=device)[torch.as_tensor(visible[first, 1], device=device)]
+    weights_x = bilinear_weights(shape[1], size, device=device)[torch.as_tensor(visible[first, 0], device=device)]
+    cell_weights = (weights_y[:, :, None] * weights_x[:, None, :]).flatten(start_dim=1)
+
+    membership = torch.as_tensor(membership, device=device, dtype=torch.float64)
+    common = torch.gather(membership @ cell_weights, 1, order)
+    parts = torch.gather(cell_weights.sum(dim=0).expand_as(common), 1, order)
+    hit = masked_sums(sorted_maps, common, thresholds)
+    covered = masked_sums(sorted_maps, parts, thresholds)
+    return part_recall_precision(hit, covered, membership.sum(dim=1, keepdim=True), has_attributes)
+
+
+def common_label_tables(seg_img, com_masks):
+    """(A, labels) bool lookup tables of the common objects of every atom, the
+    (A, objects) com_masks padded to the labels of seg_img, and the (labels,)
+    pixel count of every label of seg_img."""
+    seg_img = seg_img.flatten().long()
+    num_labels = max(int(seg_img.max()) + 1 if seg_img.numel() > 0 else 1, com_masks.shape[1])
+    tables = torch.zeros(len(com_masks), num_labels, dtype=torch.bool, device=seg_img.device)
+    tables[:, :com_masks.shape[1]] = torch.as_tensor(com_masks, device=seg_img.device)
+    return tables, torch.bincount(seg_img, minlength=num_labels)
+
+
+def segment_atom_scores(sorted_maps, order, thresholds, seg_img, com_masks):
+    """IOU of every atom and mask size against the segments of the common objects.
+
+    sorted_maps, order: the ascending order of the maps from sort_maps.
+    Atoms without common objects score zero; a mask and common segment that
+    are both empty give nan, as the per-pair evaluation did.
+
+    returns (A, Q) tensor
+    """
+    device = sorted_maps.device
+    seg_img = torch.as_tensor(np.asarray(seg_img).astype(np.int64), device=device).flatten()
+    tables, label_counts = common_label_tables(seg_img, com_masks)
+    # common object masks of all atoms, in the ascending order of their maps,
+    # from one lookup of the label of every pixel
+    common = torch.gather(tables[:, seg_img], 1, order).double()
+
+    intersection = masked_sums(sorted_maps, common, thresholds)
+    covered = masked_sums(sorted_maps, torch.ones_like(common), thresholds)
+    common_size = (tables.double() @ label_counts.double())[:, None]
+    IOU = intersection / (covered + common_size - intersection)
+    has_attributes = torch.as_tensor(com_masks.any(axis=1), device=device)
+    return torch.where(has_attributes[:, None], IOU, torch.zeros_like(IOU))
+
+
+def native_segment_atom_scores(sorted_maps, order, thresholds, shape, seg_img, com_masks):
+    """segment_atom_scores on the (H, W) grid of the maps themselves.
+
+    The segments of the common objects are projected onto the cells with
+    their exact area of overlap, so the intersection and union are
+    measured in pixels of seg_img.
+    """
+    device = sorted_maps.device
+    seg_img = torch.as_tensor(np.asarray(seg_img).astype(np.int64), device=device)
+    weights_y = area_weights(seg_img.size(0), shape[0], device=device)
+    weights_x = area_weights(seg_img.size(1), shape[1], device=device)
+    tables = common_label_tables(seg_img, com_masks)[0]
+    common = tables[:, seg_img].double()
+    common = torch.gather((weights_y @ common @ weights_x.t()).flatten(start_dim=1), 1, order)
+    cell_area = torch.full_like(common, float(seg_img.numel()) / (shape[0] * shape[1]))
+
+    intersection = masked_sums(sorted_maps, common, thresholds)
+    covered = masked_sums(sorted_maps, cell_area, thresholds)
+    IOU = intersection / (covered + common.sum(dim=1, keepdim=True) - intersection)
+    has_attributes = torch.as_tensor(com_masks.any(axis=1), device=device)
+    return torch.where(has_attributes[:, None], IOU, torch.zeros_like(IOU))
+
+
+def part_insecurity_scores(difficulty_heatmaps, classifier_heatmaps, part_locs, com_extracted_attributes,
+                           topK_classes, topKcls, remaining_mask_size_pool, quantile='exact', bins=4096,
+                           resolution='full', deviation=None):
+    """Recall and precision of the insecurity of one example, (Q,) each.
+
+    quantile='exact' thresholds the upsampled maps at their exact quantiles;
+    'histogram' never builds them, reading the thresholds off a histogram of
+    bins bins and the part values off the separable upsampling.
+    resolution='native' thresholds and scores on the grid of the heatmaps
+    instead; given a deviation meter, the mean absolute difference of its
+    scores from the full resolution ones is added to it.
+    """
+    atoms = confusion_atoms(classifier_heatmaps, topKcls)
+    # atoms without common attributes score a recall of zero and no precision
+    # whatever their maps, so only the maps of the others are built
+    atoms, com_masks, unattributed = attributed_atoms(
+        atoms, common_attribute_masks(com_extracted_attributes, topK_classes, atoms, width=len(part_locs)))
+    if len(atoms) == 0:
+        recall = precision = torch.zeros(0, len(remaining_mask_size_pool), dtype=torch.float64)
+    elif resolution == 'native':
+        maps = atom_insecurity_maps(difficulty_heatmaps, classifier_heatmaps, atoms, size=None)
+        sorted_maps, order = sort_maps(maps)
+        thresholds = mask_thresholds(sorted_maps, remaining_mask_size_pool)
+        recall, precision = native_part_atom_scores(sorted_maps, order, thresholds, maps.shape[1:], part_locs,
+                                                    com_masks)
+    elif quantile == 'histogram':
+        maps = atom_insecurity_maps(difficulty_heatmaps, classifier_heatmaps, atoms, size=None)
+        thresholds = histogram_thresholds(maps, remaining_mask_size_pool, bins=bins)
+        recall, precision = part_atom_scores(maps, thresholds, part_locs, com_masks, size=224)
+    else:
+        maps = atom_insecurity_maps(difficulty_heatmaps, classifier_heatmaps, atoms)
+        thresholds = mask_thresholds(sort_maps(maps)[0], remaining_mask_size_pool)
+        recall, precision = part_atom_scores(maps, thresholds, part_locs, com_masks)
+    recall = atom_mean(pad_atom_scores(recall, unattributed, 0.))
+    precision = atom_mean(pad_atom_scores(precision, unattributed, float('nan')))
+    if resolution == 'native' and deviation is not None:
+        full_recall, full_precision = part_insecurity_scores(difficulty_heatmaps, classifier_heatmaps, part_locs,
+                                                             com_extracted_attributes, topK_classes, topKcls,
+                                                             remaining_mask_size_pool, quantile, bins)
+        deviation.update(np.nanmean(np.abs(np.concatenate((recall - full_recall, precision - full_precision)))))
+    return recall, precision
+
+
+def segment_insecurity_scores(difficulty_heatmaps, classifier_heatmaps, seg_img, com_extracted_attributes,
+                              topK_classes, topKcls, remaining_mask_size_pool, resolution='full', deviation=None):
+    """IOU of the insecurity of one example, (Q,).
+
+    resolution='native' thresholds and scores on the grid of the heatmaps, as
+    part_insecurity_scores does, with the same deviation meter.
+    """
+    atoms = confusion_atoms(classifier_heatmaps, topKcls)
+    # atoms without common objects score zero whatever their maps
+    atoms, com_masks, unattributed = attributed_atoms(
+        atoms, common_attribute_masks(com_extracted_attributes, topK_classes, atoms))
+    if len(atoms) == 0:
+        IOU = torch.zeros(0, len(remaining_mask_size_pool), dtype=torch.float64)
+    elif resolution == 'native':
+        maps = atom_insecurity_maps(difficulty_heatmaps, classifier_heatmaps, atoms, size=None)
+        sorted_maps, order = sort_maps(maps)
+        thresholds = mask_thresholds(sorted_maps, remaining_mask_size_pool)
+        IOU = native_segment_atom_scores(sorted_maps, order, thresholds, maps.shape[1:], seg_img, com_masks)
+    else:
+        sorted_maps, order = sort_maps(atom_insecurity_maps(difficulty_heatmaps, classifier_heatmaps, atoms))
+        thresholds = mask_thresholds(sorted_maps, remaining_mask_size_pool)
+        IOU = segment_atom_scores(sorted_maps, order, thresholds, seg_img, com_masks)
+    IOU = torch.mean(pad_atom_scores(IOU, unattributed, 0.), dim=0).cpu().numpy()
+    if resolution == 'native' and deviation is not None:
+        full_IOU = segment_insecurity_scores(difficulty_heatmaps, classifier_heatmaps, seg_img,
+                                             com_extracted_attributes, topK_classes, topKcls,
+                                             remaining_mask_size_pool)
+        deviation.update(np.nanmean(np.abs(IOU - full_IOU)))
+    return IOU
+
+
+class ScoringPipeline(object):
+    """Scores the attributed examples on a pool of threads while the caller
+    attributes the next ones.
+
+    submit() queues one scoring call and returns the (key, result) of the
+    calls finished at the head of the queue, waiting on the oldest one while
+    more than max_pending are in flight, so results come back in submission
+    order and at most max_pending examples are held at once. The scoring is
+    torch on the CPU, which releases the GIL in its kernels. With workers=0
+    every call runs at submission, as in a plain loop.
+    """
+    def __init__(self, workers=0, max_pending=None):
+        self.executor = ThreadPoolExecutor(workers) if workers > 0 else None
+        self.max_pending = max_pending if max_pending is not None else 2 * workers
+        self.pending = collections.deque()
+
+    def submit(self, key, fn, *args, **kwargs):
+        if self.executor is None:
+            return [(key, fn(*args, **kwargs))]
+        self.pending.append((key, self.executor.submit(fn, *args, **kwargs)))
+        finished = []
+        while self.pending and (len(self.pending) > self.max_pending or self.pending[0][1].done()):
+            key, future = self.pending.popleft()
+            finished.append((key, future.result()))
+        return finished
+
+    def drain(self):
+        """(key, result) of all calls still in flight, in order; shuts the pool down."""
+        finished = [(key, future.result()) for key, future in self.pending]
+        self.pending.clear()
+        if self.executor is not None:
+            self.executor.shutdown()
+        return finished
@@ -15,6 +15,9 @@ import models as models
 import matplotlib.pyplot as plt
 import torchvision.models as torch_models
 from extra_setting import *
+from attribution import *
+from insecurity import *
+from eval_cache import segmentation_cache, ResultStore, common_attribute_store
 from torch.autograd import Variable
 from torch.autograd import Function
 from torchvision import utils
@@ -26,7 +29,7 @@ from sklearn.kernel_ridge import KernelRidge
 import cv2
 import seaborn as sns
 import operator
-from scipy import misc
+import itertools
 
 model_names = sorted(name for name in models.__dict__
                      if name.islower() and not name.startswith("__")
@@ -46,6 +49,35 @@ parser.add_argument('-b', '--batch-size', default=4, type=int,
                     metavar='N', help='mini-batch size (default: 200)')
 parser.add_argument('--resume', default='./ade/checkpoint_vgg16bn_hp.pth.tar', type=str, metavar='PATH',
                     help='path to latest checkpoint (default: none)')
+parser.add_argument('--batched-cam', action='store_true',
+                    help='get all top-K class gradients in one batched backward pass')
+parser.add_argument('--head-only', action='store_true',
+                    help='freeze the weights and only backpropagate above the target layer')
+parser.add_argument('--hard-batch-size', default=8, type=int, metavar='N',
+                    help='mini-batch size of the hard examples during attribution (default: 8)')
+parser.add_argument('--target-layers', default=['42'], nargs='+', metavar='NAME',
+                    help='layers to attribute at, all from one forward and backward pass (default: 42)')
+parser.add_argument('--layer-fusion', default='none', choices=['none', 'mean'],
+                    help='score each target layer on its own, or their mean after scaling each '
+                         'to a maximum of one (default: none)')
+parser.add_argument('--mask-size-step', default=0.01, type=float, metavar='Q',
+                    help='spacing of the remaining mask sizes the scores are reported at (default: 0.01)')
+parser.add_argument('--score-resolution', default='full', choices=['full', 'native'],
+                    help='threshold and score the insecurity maps upsampled to 224x224, or on the grid '
+                         'of the heatmaps for quick sweeps (default: full)')
+parser.add_argument('--deviation-every', default=10, type=int, metavar='N',
+                    help='with native resolution, also score every N-th example at full resolution and '
+                         'report the mean absolute deviation, 0 to disable (default: 10)')
+parser.add_argument('--score-workers', default=0, type=int, metavar='N',
+                    help='threads scoring the attributed examples while the next ones are attributed '
+                         '(default: 0, score each example in line)')
+parser.add_argument('--result-dir', default=None, type=str, metavar='PATH',
+                    help='directory the per-example scores are written to as they are computed, and a run '
+                         'resumed from (default: none, keep them in memory)')
+parser.add_argument('--seg-cache', default='./ade/ADE_seg_val_224.npy', type=str, metavar='PATH',
+                    help='uint8 cache of the validation label maps in the evaluation crop, '
+                         'built on first use (default: ./ade/ADE_seg_val_224.npy)')
+
 
 def main():
     global args, best_prec1
@@ -99,16 +131,18 @@ def main():
     # generate predicted difficulty score
     criterion = nn.CrossEntropyLoss().cuda()
     criterion_f = nn.CrossEntropyLoss(reduce=False).cuda()
-    prec1, prec5, all_correct_te, all_predicted_te, all_class_dis_te = validate(val_loader, model_main, model_ahp_trunk,
+    prec1, prec5, all_correct_te, all_predicted_te, all_class_dis_te, confusion = validate(val_loader, model_main, model_ahp_trunk,
                                                               model_ahp_hp, criterion, criterion_f)
     all_predicted_te = all_predicted_te.astype(int)
     np.save('./ade/all_correct_vgg16_te.npy', all_correct_te)
     np.save('./ade/all_predicted_vgg16_te.npy', all_predicted_te)
     np.save('./ade/all_class_dis_vgg16_te.npy', all_class_dis_te)
+    confusion.save('./ade/confusion_vgg16_te.npz')
 
     all_correct_te = np.load('./ade/all_correct_vgg16_te.npy')
     all_predicted_te = np.load('./ade/all_predicted_vgg16_te.npy')
     all_class_dis_te = np.load('./ade/all_class_dis_vgg16_te.npy')
+    confusion = ConfusionMeter.load('./ade/confusion_vgg16_te.npz')
 
     difficulty_scores_te, difficulty_te_idx_each = save_predicted_difficulty(train_loader, val_loader, model_ahp_trunk, model_ahp_hp)
     np.save('./ade/difficulty_scores_te_vgg16.npy', difficulty_scores_te)
@@ -145,19 +179,19 @@ def main():
         picked_list.append(imlist[K_idx_incor_classified[i]])
         picked_class_list.append(imclass[K_idx_incor_classified[i]])
 
-    attr_map_hp = AttrMap_hp(model_ahp_trunk, model_ahp_hp, target_layer_names=["42"], use_cuda=True)
-    attr_map_cls = AttrMap_cls(model_main, target_layer_names=["42"], use_cuda=True)
+    attr_map_hp = AttrMap_hp(model_ahp_trunk, model_ahp_hp, target_layer_names=args.target_layers, use_cuda=True, head_only=args.head_only)
+    attr_map_cls = AttrMap_cls(model_main, target_layer_names=args.target_layers, use_cuda=True, batched=args.batched_cam,
+                               head_only=args.head_only)
 
-    com_extracted_attributes = np.load('./ade/com_extracted_attributes_001.npy')
+    com_extracted_attributes = common_attribute_store('./ade/com_extracted_attributes_001.npy', './ade/com_extracted_attributes_001')
 
-    picked_seg_list = []
-    for i in range(K):
-        img_name = picked_list[i]
-        img_name = img_name[:27] + "annotations" + img_name[33:-3] + "png"
-        picked_seg_list.append(img_name)
+    # label maps of the picked examples, read in place from the cache of the validation annotations
+    seg_cache = segmentation_cache('./ade/ADE_gt_val.txt', args.seg_cache)
+    picked_seg_list = [seg_cache[K_idx_incor_classified[i]] for i in range(K)]
 
-    topK_prob_predicted_classes, _ = largest_indices_each_example(all_class_dis_te, 5)
+    topK_prob_predicted_classes, _ = confusion.topK_classes()
     picked_topK_prob_predicted_classes = topK_prob_predicted_classes[K_idx_incor_classified, :]
+    picked_attributed = confusion.attributed_examples(com_extracted_attributes)[K_idx_incor_classified]
 
     # save ade hard info
     adehard = './ade/ADEhard_gt_val.txt'
@@ -173,19 +207,22 @@ def main():
     get_dataset = getattr(datasets, 'adehard')
     num_classes = datasets._NUM_CLASSES['adehard']
     _, val_hard_loader = get_dataset(
-        batch_size=1, num_workers=args.workers)
+        batch_size=args.hard_batch_size, num_workers=args.workers)
 
 
-    remaining_mask_size_pool = np.arange(0.01, 1.0, 0.01)
+    remaining_mask_size_pool = np.arange(args.mask_size_step, 1.0, args.mask_size_step)
     IOU = insecurity_extraction(val_hard_loader, attr_map_hp, attr_map_cls,
                                                                      picked_list, 3, com_extracted_attributes,
                                                                      picked_seg_list,
-                                                                     picked_topK_prob_predicted_classes,
-                                                                     remaining_mask_size_pool)
+                                                                     picked_topK_prob_predicted_classes, picked_attributed,
+                                                                     remaining_mask_size_pool, args.layer_fusion, args.score_resolution, args.deviation_every, args.score_workers, args.result_dir)
 
 
     print(IOU)
-    np.save('./ade/hardness_predictor_vgg16bn_layer42_IOU.npy', IOU)
+    layers_tag = 'layer' + '_'.join(args.target_layers)
+    if args.layer_fusion == 'mean':
+        layers_tag = layers_tag + '_fused'
+    np.save('./ade/hardness_predictor_vgg16bn_{}_IOU.npy'.format(layers_tag), IOU)
 
 
 
@@ -204,17 +241,19 @@ def validate(val_loader, model_main, model_ahp_trunk, model_ahp_hp, criterion, c
 
     all_correct_te = []
     all_predicted_te = []
-    all_class_dis = np.zeros((1, 1040))
+    all_class_dis = []
+    confusion = ConfusionMeter(1040, 5)
     for i, (input, target, index) in enumerate(val_loader):
 
         input = input.cuda()
-        target = target.cuda(async=True)
+        target = target.cuda(non_blocking=True)
 
         # compute output
         output = model_main(input)
         class_dis = F.softmax(output, dim=1)
+        confusion.update(class_dis.data, target)
         class_dis = class_dis.data.cpu().numpy()
-        all_class_dis = np.concatenate((all_class_dis, class_dis), axis=0)
+        all_class_dis.append(class_dis)
 
         p_i_m = torch.max(output, dim=1)[1]
         all_predicted_te = np.concatenate((all_predicted_te, p_i_m), axis=0)
@@ -242,8 +281,8 @@ def validate(val_loader, model_main, model_ahp_trunk, model_ahp_hp, criterion, c
                 i, len(val_loader), batch_time=batch_time,
                 top1=top1, top5=top5))
 
-    all_class_dis = all_class_dis[1:, :]
-    return top1.avg, top5.avg, all_correct_te, all_predicted_te, all_class_dis
+    all_class_dis = np.concatenate(all_class_dis, axis=0)
+    return top1.avg, top5.avg, all_correct_te, all_predicted_te, all_class_dis, confusion
 
 
 def largest_indices(ary, n):
@@ -254,16 +293,6 @@ def largest_indices(ary, n):
     return np.unravel_index(indices, ary.shape)
 
 
-def largest_indices_each_example(all_response, topK):
-    topK_maxIndex = np.zeros((np.size(all_response, 0), topK), dtype=np.int16)
-    topK_maxValue = np.zeros((np.size(all_response, 0), topK))
-    for i in range(np.size(topK_maxIndex, 0)):
-        arr = all_response[i, :]
-        topK_maxIndex[i, :] = np.argsort(arr)[-topK:][::-1]
-        topK_maxValue[i, :] = np.sort(arr)[-topK:][::-1]
-    return topK_maxIndex, topK_maxValue
-
-
 def save_predicted_difficulty(train_loader, val_loader, model_ahp_trunk, model_ahp_hp):
     model_ahp_trunk.eval()
     model_ahp_hp.eval()
@@ -330,69 +359,25 @@ def accuracy(output, target, topk=(1,)):
 
 
 
-class FeatureExtractor_hp():
-    """ Class for extracting activations and
-    registering gradients from targetted intermediate layers """
-    def __init__(self, model, target_layers):
-        self.model = model
-        self.target_layers = target_layers
-        self.gradients = []
-
-    def save_gradient(self, grad):
-        self.gradients.append(grad)
-
-    def __call__(self, x):
-        outputs = []
-        self.gradients = []
-        for name, module in self.model._modules['module']._modules['features']._modules.items():
-            x = module(x)
-            if name in self.target_layers:
-                x.register_hook(self.save_gradient)
-                outputs += [x]
-
-        x = x.view(x.size(0), -1)
-        x = self.model._modules['module'].classifier(x)
-        return outputs, x
-
-
-class FeatureExtractor_cls():
-    """ Class for extracting activations and
-    registering gradients from targetted intermediate layers """
-    def __init__(self, model, target_layers):
-        self.model = model
-        self.target_layers = target_layers
-        self.gradients = []
-
-    def save_gradient(self, grad):
-        self.gradients.append(grad)
-
-    def __call__(self, x):
-        outputs = []
-        self.gradients = []
-        for name, module in self.model._modules['module']._modules['features']._modules.items():
-            x = module(x)
-            if name in self.target_layers:
-                x.register_hook(self.save_gradient)
-                outputs += [x]
-        return outputs, x
-
 class ModelOutputs_hp():
     """ Class for making a forward pass, and getting:
     1. The network output.
     2. Activations from intermeddiate targetted layers.
     3. Gradients from intermeddiate targetted layers. """
-    def __init__(self, model_hp_trunk, model_hp_head, target_layers):
+    def __init__(self, model_hp_trunk, model_hp_head, target_layers, head_only=False):
+        self.frozen_models = (model_hp_trunk, model_hp_head) if head_only else ()
         self.model_hp_trunk = model_hp_trunk
         self.model_hp_head = model_hp_head
-        self.feature_extractor = FeatureExtractor_hp(self.model_hp_trunk, target_layers)
+        self.feature_extractor = FeatureExtractor(self.model_hp_trunk, target_layers, head_only)
 
     def get_gradients(self):
         return self.feature_extractor.gradients
 
     def __call__(self, x):
-        target_activations, output  = self.feature_extractor(x)
-        _, output = self.model_hp_head(output)
-        return target_activations, output
+        with frozen_parameters(*self.frozen_models):
+            target_activations, output  = self.feature_extractor(x)
+            _, output = self.model_hp_head(output)
+            return target_activations, output
 
 
 class ModelOutputs_cls():
@@ -400,18 +385,18 @@ class ModelOutputs_cls():
     1. The network output.
     2. Activations from intermeddiate targetted layers.
     3. Gradients from intermeddiate targetted layers. """
-    def __init__(self, model, target_layers):
+    def __init__(self, model, target_layers, head_only=False):
+        self.frozen_models = (model,) if head_only else ()
         self.model = model
-        self.feature_extractor = FeatureExtractor_cls(self.model, target_layers)
+        self.feature_extractor = FeatureExtractor(self.model, target_layers, head_only)
 
     def get_gradients(self):
         return self.feature_extractor.gradients
 
     def __call__(self, x):
-        target_activations, output = self.feature_extractor(x)
-        output = output.view(output.size(0), -1)
-        output = self.model._modules['module'].classifier(output)  # travel many fc layers
-        return target_activations, output
+        with frozen_parameters(*self.frozen_models):
+            target_activations, output = self.feature_extractor(x)
+            return target_activations, output
 
 
 def preprocess_image(img):
@@ -453,7 +438,7 @@ def show_segment_on_image(img, mask, mark_locs=None, is_cls=True):
 
 
 class AttrMap_hp:
-    def __init__(self, model_hp_trunk, model_hp_head, target_layer_names, use_cuda):
+    def __init__(self, model_hp_trunk, model_hp_head, target_layer_names, use_cuda, head_only=False):
         self.model_hp_trunk = model_hp_trunk
         self.model_hp_head = model_hp_head
         self.model_hp_trunk.eval()
@@ -463,139 +448,152 @@ class AttrMap_hp:
             self.model_hp_trunk = model_hp_trunk.cuda()
             self.model_hp_head = model_hp_head.cuda()
 
-        self.extractor = ModelOutputs_hp(self.model_hp_trunk, self.model_hp_head, target_layer_names)
+        self.target_layer_names = target_layer_names
+        self.extractor = ModelOutputs_hp(self.model_hp_trunk, self.model_hp_head, target_layer_names, head_only)
 
     def forward(self, input):
         return self.model_hp_head(self.model_hp_trunk(input))
 
-    def __call__(self, input):
+    def pyramid(self, input):
+        # (L, B, H, W) heatmaps of all target layers on the grid of the finest one
         if self.cuda:
             features, output = self.extractor(input.cuda())
         else:
             features, output = self.extractor(input)
 
-        self.model_hp_trunk.zero_grad()
-        self.model_hp_head.zero_grad()
-        output.backward(retain_graph=True)
-
-        grads_val = self.extractor.get_gradients()[-1].cpu().data.numpy()
-
-        gradients = np.copy(grads_val)
-        gradients[gradients < 0.0] = 0.0
-        gradients = gradients.squeeze()
+        # samples do not interact in eval mode, so differentiating the summed
+        # score gives each sample its own gradient in a single pass
+        grads_val = torch.autograd.grad(torch.sum(output), features)
 
-        target = features[-1]
-        target = target.cpu().data.numpy()[0, :]
+        heatmaps = [gradcam_maps(target, torch.clamp(gradients, min=0.0)) for target, gradients in zip(features, grads_val)]
+        return resample_maps(heatmaps)
 
-        heatmaps = target * gradients
-        heatmaps = np.sum(heatmaps, axis=0)
-        return heatmaps
+    def __call__(self, input):
+        heatmaps = self.pyramid(input)
+        return heatmaps[0] if len(heatmaps) == 1 else heatmaps
 
 
 class AttrMap_cls:
-    def __init__(self, model, target_layer_names, use_cuda):
+    def __init__(self, model, target_layer_names, use_cuda, batched=False, head_only=False):
         self.model = model
         self.model.eval()
         self.cuda = use_cuda
+        self.batched = batched
         if self.cuda:
             self.model = model.cuda()
 
-        self.extractor = ModelOutputs_cls(self.model, target_layer_names)
+        self.target_layer_names = target_layer_names
+        self.extractor = ModelOutputs_cls(self.model, target_layer_names, head_only)
 
     def forward(self, input):
         return self.model(input)
 
-    def __call__(self, input, TopKclass = 5, topK_prob_predicted_classes=None):
+    def pyramid(self, input, TopKclass = 5, topK_prob_predicted_classes=None):
+        # (L, B, H, W, K) heatmaps of all target layers on the grid of the finest one
         if self.cuda:
             features, output = self.extractor(input.cuda())
         else:
             features, output = self.extractor(input)
 
-        target = features[-1]
-        target = target.cpu().data.numpy()[0, :]
-
-        classifier_heatmaps = np.zeros((np.size(target,2), np.size(target,2), np.size(topK_prob_predicted_classes)))
-        for i_cls in range(np.size(topK_prob_predicted_classes)):
-            one_hot = np.zeros((1, output.size()[-1]), dtype=np.float32)
-            one_hot[0][topK_prob_predicted_classes[i_cls]] = 1
-            one_hot = Variable(torch.from_numpy(one_hot), requires_grad=True)
-            if self.cuda:
-                one_hot = torch.sum(one_hot.cuda() * output)
-            else:
-                one_hot = torch.sum(one_hot * output)
-            self.model.zero_grad()
-            one_hot.backward(retain_graph=True)
-            grads_val = self.extractor.get_gradients()[-1].cpu().data.numpy()
-            grads_val = grads_val.squeeze()
-            heatmaps = target * grads_val
-            heatmaps = np.sum(heatmaps, axis=0)
-            classifier_heatmaps[:, :, i_cls] = heatmaps
-
-        return classifier_heatmaps
-
+        # one row of top-K classes per example in the batch
+        topK_prob_predicted_classes = np.reshape(topK_prob_predicted_classes, (output.size(0), -1))
 
+        if self.batched:
+            # (K, B, C, H, W) gradients of every layer from a single batched backward pass
+            grads_val = batched_class_gradients(output, features, topK_prob_predicted_classes)
+        else:
+            grads_val = []
+            for i_cls in range(np.size(topK_prob_predicted_classes, 1)):
+                one_hot = np.zeros((output.size(0), output.size()[-1]), dtype=np.float32)
+                one_hot[np.arange(output.size(0)), topK_prob_predicted_classes[:, i_cls]] = 1
+                one_hot = torch.sum(torch.from_numpy(one_hot).to(output.device) * output)
+                grads_val.append(torch.autograd.grad(one_hot, features, retain_graph=True))
+            grads_val = [torch.stack(gradients) for gradients in zip(*grads_val)]
 
-def insecurity_extraction(val_loader, attr_map_hp, attr_map_cls, imglist, topKcls, com_extracted_attributes, seg_list, topK_prob_predicted_classes, remaining_mask_size_pool):
-
-
-    IOU = np.zeros((len(imglist), np.size(remaining_mask_size_pool)))
-
-    for i, (input, target, index) in enumerate(val_loader):
-        print('processing sample', i)
-
-        img = cv2.imread(imglist[i])
-
-        difficulty_heatmaps = attr_map_hp(input)
-
-        classifier_heatmaps = attr_map_cls(input, 1040, topK_prob_predicted_classes[i, :])
-        classifier_heatmaps[classifier_heatmaps < 0] = 1e-7
-
-        seg_img = misc.imread(seg_list[i])
-        seg_img = np.resize(seg_img, (224, 224))
-
-        confusion_classes = np.argsort(classifier_heatmaps, axis=2)[:, :, -topKcls:]
-        confusion_classes = np.sort(confusion_classes, axis=2)
-
-        misclass_pairs = np.zeros((1, 2))
-        for i_cls in range(topKcls):
-            for j_cls in range(i_cls+1, topKcls):
-                cur_misclass_pairs = np.concatenate((np.reshape(confusion_classes[:,:,i_cls].squeeze(), (-1, 1)), np.reshape(confusion_classes[:,:,j_cls].squeeze(), (-1, 1))), axis=1)
-                misclass_pairs = np.concatenate((misclass_pairs, cur_misclass_pairs), axis=0)
-
-        misclass_pairs = np.unique(misclass_pairs, axis=0)
-        misclass_pairs = misclass_pairs[~np.all(misclass_pairs == 0, axis=1)]
-        misclass_pairs = misclass_pairs.astype(int)
-
-        atom_num = np.size(misclass_pairs, axis=0)
-
-        for i_remain in range(np.size(remaining_mask_size_pool)):
-            remaining_mask_size = remaining_mask_size_pool[i_remain]
-            noeffect_atom = 0
-            total_IOU_i = 0
-            for i_atom in range(atom_num):
-
-                insecurity = classifier_heatmaps[:, :, misclass_pairs[i_atom, 0]].squeeze() * classifier_heatmaps[:, :, misclass_pairs[i_atom, 1]].squeeze() * difficulty_heatmaps
-                insecurity = cv2.resize(insecurity, (224, 224))
-                insecurity_mask = np.copy(insecurity)
-
-                threshold = np.sort(insecurity_mask.flatten())[int(-remaining_mask_size * 224 * 224)]
-                insecurity_mask[insecurity_mask > threshold] = 1
-                insecurity_mask[insecurity_mask < 1] = 0
-
-                com_attributes = com_extracted_attributes[topK_prob_predicted_classes[i, misclass_pairs[i_atom, 0]], topK_prob_predicted_classes[i, misclass_pairs[i_atom, 1]]]
-
-                if len(com_attributes) == 0:
-                    continue
-                com_attributes = np.array(com_attributes)
-
-                commom_seg_img = np.zeros((224, 224))
-                for i_com in range(np.size(com_attributes)):
-                    commom_seg_img[seg_img == com_attributes[i_com]] = 1
-                IOU_i = np.sum(insecurity_mask * commom_seg_img) / np.sum(insecurity_mask + commom_seg_img - insecurity_mask * commom_seg_img)
-                total_IOU_i = total_IOU_i + IOU_i
-            IOU[i, i_remain] = total_IOU_i / (atom_num - noeffect_atom)
+        heatmaps = [gradcam_maps(target, gradients) for target, gradients in zip(features, grads_val)]
+        return resample_maps(heatmaps).permute(0, 2, 3, 4, 1)
 
-    return np.nanmean(IOU, axis=0)
+    def __call__(self, input, TopKclass = 5, topK_prob_predicted_classes=None):
+        heatmaps = self.pyramid(input, TopKclass, topK_prob_predicted_classes)
+        return heatmaps[0] if len(heatmaps) == 1 else heatmaps
+
+
+
+def insecurity_extraction(val_loader, attr_map_hp, attr_map_cls, imglist, topKcls, com_extracted_attributes, seg_list, topK_prob_predicted_classes, attributed, remaining_mask_size_pool, layer_fusion='none', score_resolution='full', deviation_every=10, score_workers=0, result_dir=None):
+
+
+    # one row of results per target layer, or a single one for their fusion
+    num_layers = 1 if layer_fusion == 'mean' else len(attr_map_hp.target_layer_names)
+    # the scores of every example, on disk under result_dir; what they depend on is
+    # recorded with them so that a resumed run only adds to scores of the same evaluation
+    store = ResultStore(result_dir, ('IOU',), (num_layers, len(imglist), np.size(remaining_mask_size_pool)),
+                        dict(evaluation=os.path.basename(__file__), topKcls=topKcls, layer_fusion=layer_fusion,
+                             layers=list(attr_map_hp.target_layer_names),
+                             score_resolution=score_resolution, mask_sizes=np.asarray(remaining_mask_size_pool).tolist()))
+    IOU = store['IOU']
+
+    deviation = AverageMeter()
+    pipeline = ScoringPipeline(score_workers)
+
+    def collect(finished):
+        for (index, example_deviation), scores in finished:
+            IOU[index] = scores
+            store.commit(index)
+            if example_deviation is not None and example_deviation.count > 0:
+                deviation.update(example_deviation.avg)
+
+    # examples none of whose top-K class pairs have common attributes score as if none of
+    # their atoms had any, whatever their heatmaps, so they are never attributed
+    skipped = np.flatnonzero(~attributed)
+    IOU[..., skipped, :] = 0.
+    store.commit((Ellipsis, skipped))
+
+    i_start = 0
+    for input, target, index in val_loader:
+        # the examples of the batch still to score, the others are done or never attributed
+        batch_size = input.size(0)
+        todo = np.flatnonzero(~store.done[..., i_start:i_start + batch_size].reshape(-1, batch_size).all(axis=0))
+        if len(todo) == 0:
+            i_start = i_start + batch_size
+            continue
+        input = input[torch.as_tensor(todo)]
+        batch_difficulty_heatmaps = attr_map_hp.pyramid(input)
+        batch_classifier_heatmaps = attr_map_cls.pyramid(input, 1040, topK_prob_predicted_classes[i_start + todo, :])
+        if layer_fusion == 'mean':
+            batch_difficulty_heatmaps = fuse_layer_maps(batch_difficulty_heatmaps)
+            batch_classifier_heatmaps = fuse_layer_maps(batch_classifier_heatmaps)
+        batch_difficulty_heatmaps = batch_difficulty_heatmaps.cpu().numpy()
+        batch_classifier_heatmaps = batch_classifier_heatmaps.cpu().numpy()
+
+        for i_layer, (i_batch, i) in itertools.product(range(num_layers), enumerate(i_start + todo)):
+            if store.done[i_layer, i]:
+                continue
+
+            print('processing sample', i)
+
+
+            difficulty_heatmaps = batch_difficulty_heatmaps[i_layer, i_batch]
+
+            classifier_heatmaps = batch_classifier_heatmaps[i_layer, i_batch]
+            classifier_heatmaps[classifier_heatmaps < 0] = 1e-7
+
+            seg_img = seg_list[i]
+
+            example_deviation = AverageMeter() if deviation_every > 0 and i % deviation_every == 0 else None
+            collect(pipeline.submit(((i_layer, i), example_deviation), segment_insecurity_scores, difficulty_heatmaps, classifier_heatmaps, seg_img, com_extracted_attributes,
+                                    topK_prob_predicted_classes[i, :], topKcls, remaining_mask_size_pool,
+                                    resolution=score_resolution,
+                                    deviation=example_deviation))
+        i_start = i_start + batch_size
+
+    collect(pipeline.drain())
+
+    if score_resolution == 'native' and deviation.count > 0:
+        print('mean absolute deviation of the native resolution scores from full resolution', deviation.avg)
+    IOU = np.nanmean(IOU, axis=1)
+    if num_layers == 1:
+        return IOU[0]
+    return IOU
 
 
 
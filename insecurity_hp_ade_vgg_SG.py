@@ -0,0 +1,558 @@
+import argparse
+import os
+import shutil
+import time
+
+import torch
+import torch.nn as nn
+import torch.nn.parallel
+import torch.backends.cudnn as cudnn
+import torch.optim
+import torch.utils.data
+import numpy as np
+import datasets
+import models as models
+import matplotlib.pyplot as plt
+import torchvision.models as torch_models
+from extra_setting import *
+from attribution import *
+from insecurity import *
+from eval_cache import segmentation_cache, ResultStore, common_attribute_store
+from torch.autograd import Variable
+from torch.autograd import Function
+from torchvision import utils
+import scipy.io as sio
+from sklearn.svm import SVR
+from sklearn.model_selection import GridSearchCV
+from sklearn.model_selection import learning_curve
+from sklearn.kernel_ridge import KernelRidge
+import cv2
+import seaborn as sns
+import operator
+
+model_names = sorted(name for name in models.__dict__
+                     if name.islower() and not name.startswith("__")
+                     and callable(models.__dict__[name]))
+
+parser = argparse.ArgumentParser(description='PyTorch end2end ade Training')
+parser.add_argument('-d', '--dataset', default='ade', help='dataset name')
+parser.add_argument('--arch', '-a', metavar='ARCH', default='resnet20',
+                    choices=model_names,
+                    help='model architecture: ' +
+                         ' | '.join(model_names) +
+                         ' (default: resnet20)')
+parser.add_argument('-j', '--workers', default=4, type=int, metavar='N',
+                    help='number of data loading workers (default: 1)')
+parser.add_argument('--gpu', default='0', help='index of gpus to use')
+parser.add_argument('-b', '--batch-size', default=4, type=int,
+                    metavar='N', help='mini-batch size (default: 200)')
+parser.add_argument('--resume', default='./ade/checkpoint_vgg16bn_hp.pth.tar', type=str, metavar='PATH',
+                    help='path to latest checkpoint (default: none)')
+parser.add_argument('--head-only', action='store_true',
+                    help='freeze the weights and only backpropagate above the target layer')
+parser.add_argument('--sg-samples', default=16, type=int, metavar='N',
+                    help='noisy copies of every image to average the heatmaps over (default: 16)')
+parser.add_argument('--sg-noise', default=0.15, type=float,
+                    help='noise standard deviation relative to the value range of the image (default: 0.15)')
+parser.add_argument('--sg-memory-budget', default=2048, type=int, metavar='MB',
+                    help='memory for one chunk of noisy copies (default: 2048)')
+parser.add_argument('--mask-size-step', default=0.01, type=float, metavar='Q',
+                    help='spacing of the remaining mask sizes the scores are reported at (default: 0.01)')
+parser.add_argument('--score-resolution', default='full', choices=['full', 'native'],
+                    help='threshold and score the insecurity maps upsampled to 224x224, or on the grid '
+                         'of the heatmaps for quick sweeps (default: full)')
+parser.add_argument('--deviation-every', default=10, type=int, metavar='N',
+                    help='with native resolution, also score every N-th example at full resolution and '
+                         'report the mean absolute deviation, 0 to disable (default: 10)')
+parser.add_argument('--score-workers', default=0, type=int, metavar='N',
+                    help='threads scoring the attributed examples while the next ones are attributed '
+                         '(default: 0, score each example in line)')
+parser.add_argument('--result-dir', default=None, type=str, metavar='PATH',
+                    help='directory the per-example scores are written to as they are computed, and a run '
+                         'resumed from (default: none, keep them in memory)')
+parser.add_argument('--seg-cache', default='./ade/ADE_seg_val_224.npy', type=str, metavar='PATH',
+                    help='uint8 cache of the validation label maps in the evaluation crop, '
+                         'built on first use (default: ./ade/ADE_seg_val_224.npy)')
+
+
+def main():
+    global args, best_prec1
+    args = parser.parse_args()
+
+    # select gpus
+    args.gpu = args.gpu.split(',')
+    os.environ['CUDA_VISIBLE_DEVICES'] = ','.join(args.gpu)
+
+    # data loader
+    assert callable(datasets.__dict__[args.dataset])
+    get_dataset = getattr(datasets, args.dataset)
+    num_classes = datasets._NUM_CLASSES[args.dataset]
+    train_loader, val_loader = get_dataset(
+        batch_size=args.batch_size, num_workers=args.workers)
+
+    # create model
+    model_main = models.__dict__['vgg16_bn'](pretrained=True)
+    model_main.classifier[-1] = nn.Linear(model_main.classifier[-1].in_features, num_classes)
+    model_main = torch.nn.DataParallel(model_main, device_ids=range(len(args.gpu))).cuda()
+    if args.resume:
+        if os.path.isfile(args.resume):
+            print("=> loading checkpoint '{}'".format(args.resume))
+            checkpoint = torch.load(args.resume)
+            model_main.module.load_state_dict(checkpoint['state_dict_m'])
+        else:
+            print("=> no checkpoint found at '{}'".format(args.resume))
+
+    model_ahp_trunk = models.__dict__['vgg16_bn'](pretrained=True)
+    model_ahp_trunk.classifier[-1] = nn.Linear(model_ahp_trunk.classifier[-1].in_features, 1000)
+    if args.resume:
+        if os.path.isfile(args.resume):
+            print("=> loading checkpoint '{}'".format(args.resume))
+            checkpoint = torch.load(args.resume)
+            model_ahp_trunk.load_state_dict(checkpoint['state_dict_ahp_trunk'])
+        else:
+            print("=> no checkpoint found at '{}'".format(args.resume))
+    model_ahp_trunk = torch.nn.DataParallel(model_ahp_trunk, device_ids=range(len(args.gpu))).cuda()
+
+    model_ahp_hp = models.__dict__['ahp_net_hp_res50_presigmoid']()
+    if args.resume:
+        if os.path.isfile(args.resume):
+            print("=> loading checkpoint '{}'".format(args.resume))
+            checkpoint = torch.load(args.resume)
+            model_ahp_hp.load_state_dict(checkpoint['state_dict_ahp_hp'])
+        else:
+            print("=> no checkpoint found at '{}'".format(args.resume))
+    model_ahp_hp = torch.nn.DataParallel(model_ahp_hp, device_ids=range(len(args.gpu))).cuda()
+
+
+    # generate predicted difficulty score
+    criterion = nn.CrossEntropyLoss().cuda()
+    criterion_f = nn.CrossEntropyLoss(reduce=False).cuda()
+    prec1, prec5, all_correct_te, all_predicted_te, all_class_dis_te, confusion = validate(val_loader, model_main, model_ahp_trunk,
+                                                              model_ahp_hp, criterion, criterion_f)
+    all_predicted_te = all_predicted_te.astype(int)
+    np.save('./ade/all_correct_vgg16_te.npy', all_correct_te)
+    np.save('./ade/all_predicted_vgg16_te.npy', all_predicted_te)
+    np.save('./ade/all_class_dis_vgg16_te.npy', all_class_dis_te)
+    confusion.save('./ade/confusion_vgg16_te.npz')
+
+    all_correct_te = np.load('./ade/all_correct_vgg16_te.npy')
+    all_predicted_te = np.load('./ade/all_predicted_vgg16_te.npy')
+    all_class_dis_te = np.load('./ade/all_class_dis_vgg16_te.npy')
+    confusion = ConfusionMeter.load('./ade/confusion_vgg16_te.npz')
+
+    difficulty_scores_te, difficulty_te_idx_each = save_predicted_difficulty(train_loader, val_loader, model_ahp_trunk, model_ahp_hp)
+    np.save('./ade/difficulty_scores_te_vgg16.npy', difficulty_scores_te)
+    np.save('./ade/difficulty_te_idx_each_vgg16.npy', difficulty_te_idx_each)
+
+    difficulty_scores_te = np.load('./ade/difficulty_scores_te_vgg16.npy')
+    difficulty_te_idx_each = np.load('./ade/difficulty_te_idx_each_vgg16.npy')
+
+
+    # pickup K hardnest examples
+    test_info = zip(all_correct_te, difficulty_scores_te, difficulty_te_idx_each)
+    test_info = sorted(test_info, key=lambda test: test[1])  # from small to large
+    all_correct_te, difficulty_scores_te, difficulty_te_idx_each = [list(l) for l in zip(*test_info)]
+    all_correct_te = np.array(all_correct_te)
+    difficulty_scores_te = np.array(difficulty_scores_te)
+    difficulty_te_idx_each = np.array(difficulty_te_idx_each)
+
+    K = 100
+    K_idx_incor_classified = difficulty_te_idx_each[-K:]
+    K_idx_incor_classified = K_idx_incor_classified.astype(int)
+
+    imlist = []
+    imclass = []
+
+    with open('./ade/ADE_gt_val.txt', 'r') as rf:
+        for line in rf.readlines():
+            impath, imlabel, imindex = line.strip().split()
+            imlist.append(impath)
+            imclass.append(imlabel)
+
+    picked_list = []
+    picked_class_list = []
+    for i in range(K):
+        picked_list.append(imlist[K_idx_incor_classified[i]])
+        picked_class_list.append(imclass[K_idx_incor_classified[i]])
+
+    attr_map_hp = AttrMap_hp(model_ahp_trunk, model_ahp_hp, target_layer_names=["42"], use_cuda=True, head_only=args.head_only,
+                             samples=args.sg_samples, noise_level=args.sg_noise,
+                             memory_budget=args.sg_memory_budget)
+    attr_map_cls = AttrMap_cls(model_main, target_layer_names=["42"], use_cuda=True, head_only=args.head_only,
+                               samples=args.sg_samples, noise_level=args.sg_noise,
+                               memory_budget=args.sg_memory_budget)
+
+    com_extracted_attributes = common_attribute_store('./ade/com_extracted_attributes_001.npy', './ade/com_extracted_attributes_001')
+
+    # label maps of the picked examples, read in place from the cache of the validation annotations
+    seg_cache = segmentation_cache('./ade/ADE_gt_val.txt', args.seg_cache)
+    picked_seg_list = [seg_cache[K_idx_incor_classified[i]] for i in range(K)]
+
+    topK_prob_predicted_classes, _ = confusion.topK_classes()
+    picked_topK_prob_predicted_classes = topK_prob_predicted_classes[K_idx_incor_classified, :]
+    picked_attributed = confusion.attributed_examples(com_extracted_attributes)[K_idx_incor_classified]
+
+    # save ade hard info
+    adehard = './ade/ADEhard_gt_val.txt'
+    fl = open(adehard, 'w')
+    for ii in range(K):
+        example_info = picked_list[ii] + " " + picked_class_list[ii] + " " + str(K_idx_incor_classified[ii])
+        fl.write(example_info)
+        fl.write("\n")
+    fl.close()
+
+    # data loader
+    assert callable(datasets.__dict__['adehard'])
+    get_dataset = getattr(datasets, 'adehard')
+    num_classes = datasets._NUM_CLASSES['adehard']
+    _, val_hard_loader = get_dataset(
+        batch_size=1, num_workers=args.workers)
+
+
+    remaining_mask_size_pool = np.arange(args.mask_size_step, 1.0, args.mask_size_step)
+    IOU = insecurity_extraction(val_hard_loader, attr_map_hp, attr_map_cls,
+                                                                     picked_list, 3, com_extracted_attributes,
+                                                                     picked_seg_list,
+                                                                     picked_topK_prob_predicted_classes, picked_attributed,
+                                                                     remaining_mask_size_pool, args.score_resolution, args.deviation_every, args.score_workers, args.result_dir)
+
+
+    print(IOU)
+
+    np.save('./ade/hardness_predictor_vgg16_layer42_SG_IOU.npy', IOU)
+
+
+
+def validate(val_loader, model_main, model_ahp_trunk, model_ahp_hp, criterion, criterion_f):
+    batch_time = AverageMeter()
+    top1 = AverageMeter()
+    top5 = AverageMeter()
+
+    # switch to evaluate mode
+    model_main.eval()
+    model_ahp_trunk.eval()
+    model_ahp_hp.eval()
+    end = time.time()
+
+    all_correct_te = []
+    all_predicted_te = []
+    all_class_dis = []
+    confusion = ConfusionMeter(1040, 5)
+    for i, (input, target, index) in enumerate(val_loader):
+
+        input = input.cuda()
+        target = target.cuda(non_blocking=True)
+
+        # compute output
+        output = model_main(input)
+        class_dis = F.softmax(output, dim=1)
+        confusion.update(class_dis.data, target)
+        class_dis = class_dis.data.cpu().numpy()
+        all_class_dis.append(class_dis)
+
+        p_i_m = torch.max(output, dim=1)[1]
+        all_predicted_te = np.concatenate((all_predicted_te, p_i_m), axis=0)
+        p_i_m = p_i_m.long()
+        p_i_m[p_i_m - target == 0] = -1
+        p_i_m[p_i_m > -1] = 0
+        p_i_m[p_i_m == -1] = 1
+        correct = p_i_m.float()
+        all_correct_te = np.concatenate((all_correct_te, correct), axis=0)
+
+        # measure accuracy and record loss
+        prec1, prec5 = accuracy(output, target, topk=(1, 5))
+        top1.update(prec1[0], input.size(0))
+        top5.update(prec5[0], input.size(0))
+
+        # measure elapsed time
+        batch_time.update(time.time() - end)
+        end = time.time()
+
+        if i % args.print_freq == 0:
+            print('Test: [{0}/{1}]\t'
+                  'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
+                  'Prec@1 {top1.val:.3f} ({top1.avg:.3f})\t'
+                  'Prec@5 {top5.val:.3f} ({top5.avg:.3f})'.format(
+                i, len(val_loader), batch_time=batch_time,
+                top1=top1, top5=top5))
+
+
+    all_class_dis = np.concatenate(all_class_dis, axis=0)
+    return top1.avg, top5.avg, all_correct_te, all_predicted_te, all_class_dis, confusion
+
+
+def largest_indices(ary, n):
+    """Returns the n largest indices from a numpy array."""
+    flat = ary.flatten()
+    indices = np.argpartition(flat, -n)[-n:]
+    indices = indices[np.argsort(-flat[indices])]
+    return np.unravel_index(indices, ary.shape)
+
+
+def save_predicted_difficulty(train_loader, val_loader, model_ahp_trunk, model_ahp_hp):
+    model_ahp_trunk.eval()
+    model_ahp_hp.eval()
+
+    hardness_scores_val = []
+    hardness_scores_idx_val = []
+    for i, (input, target, index) in enumerate(val_loader):
+        input = input.cuda()
+        trunk_output = model_ahp_trunk(input)
+        predicted_hardness_scores, _ = model_ahp_hp(trunk_output)
+        scores = predicted_hardness_scores.data.cpu().numpy().squeeze()
+        hardness_scores_val = np.concatenate((hardness_scores_val, scores), axis=0)
+        index = index.numpy()
+        hardness_scores_idx_val = np.concatenate((hardness_scores_idx_val, index), axis=0)
+
+    return hardness_scores_val, hardness_scores_idx_val
+
+
+def save_checkpoint(state, filename='checkpoint_res.pth.tar'):
+    torch.save(state, filename)
+
+
+class AverageMeter(object):
+    """Computes and stores the average and current value"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.val = 0
+        self.avg = 0
+        self.sum = 0
+        self.count = 0
+
+    def update(self, val, n=1):
+        self.val = val
+        self.sum += val * n
+        self.count += n
+        self.avg = self.sum / self.count
+
+def adjust_learning_rate(optimizer, epoch):
+    """Sets the learning rate to the initial LR decayed by 10 every 30 epochs"""
+    lr = args.lr * (0.1 ** (epoch // 30))
+    for param_group in optimizer.param_groups:
+        param_group['lr'] = lr
+
+
+def accuracy(output, target, topk=(1,)):
+    """Computes the precision@k for the specified values of k"""
+    maxk = max(topk)
+    batch_size = target.size(0)
+
+    _, pred = output.topk(maxk, 1, True, True)
+    pred = pred.t()
+    correct = pred.eq(target.view(1, -1).expand_as(pred))
+
+    res = []
+    for k in topk:
+        correct_k = correct[:k].view(-1).float().sum(0, keepdim=True)
+        res.append(correct_k.mul_(100.0 / batch_size))
+    return res
+
+
+
+
+
+class ModelOutputs_hp():
+    """ Class for making a forward pass, and getting:
+    1. The network output.
+    2. Activations from intermeddiate targetted layers.
+    3. Gradients from intermeddiate targetted layers. """
+    def __init__(self, model_hp_trunk, model_hp_head, target_layers, head_only=False):
+        self.frozen_models = (model_hp_trunk, model_hp_head) if head_only else ()
+        self.model_hp_trunk = model_hp_trunk
+        self.model_hp_head = model_hp_head
+        self.feature_extractor = FeatureExtractor(self.model_hp_trunk, target_layers, head_only)
+
+    def get_gradients(self):
+        return self.feature_extractor.gradients
+
+    def __call__(self, x):
+        with frozen_parameters(*self.frozen_models):
+            target_activations, output  = self.feature_extractor(x)
+            _, output = self.model_hp_head(output)
+            return target_activations, output
+
+
+class ModelOutputs_cls():
+    """ Class for making a forward pass, and getting:
+    1. The network output.
+    2. Activations from intermeddiate targetted layers.
+    3. Gradients from intermeddiate targetted layers. """
+    def __init__(self, model, target_layers, head_only=False):
+        self.frozen_models = (model,) if head_only else ()
+        self.model = model
+        self.feature_extractor = FeatureExtractor(self.model, target_layers, head_only)
+
+    def get_gradients(self):
+        return self.feature_extractor.gradients
+
+    def __call__(self, x):
+        with frozen_parameters(*self.frozen_models):
+            target_activations, output = self.feature_extractor(x)
+            return target_activations, output
+
+
+def preprocess_image(img):
+
+    means = [0.4706145, 0.46000465, 0.45479808]
+    stds = [0.26668432, 0.26578658, 0.2706199]
+
+    preprocessed_img = img.copy()[: , :, ::-1]
+    for i in range(3):
+        preprocessed_img[:, :, i] = preprocessed_img[:, :, i] - means[i]
+        preprocessed_img[:, :, i] = preprocessed_img[:, :, i] / stds[i]
+    preprocessed_img = \
+        np.ascontiguousarray(np.transpose(preprocessed_img, (2, 0, 1)))
+    preprocessed_img = torch.from_numpy(preprocessed_img)
+    preprocessed_img.unsqueeze_(0)
+    input = Variable(preprocessed_img, requires_grad = True)
+    return input
+
+def show_cam_on_image(img, mask):
+    heatmap = cv2.applyColorMap(np.uint8(255*mask), cv2.COLORMAP_JET)
+    heatmap = np.float32(heatmap) / 255
+    cam = heatmap + np.float32(img)
+    cam = cam / np.max(cam)
+    cam = np.uint8(255 * cam)
+    return cam
+
+def show_segment_on_image(img, mask, mark_locs=None, is_cls=True):
+    img = np.float32(img)
+
+    mask = np.concatenate((mask[:, :, np.newaxis], mask[:, :, np.newaxis], mask[:, :, np.newaxis]), axis=2)
+    img = np.uint8(255 * mask * img)
+    if is_cls == False:
+        if np.sum(mark_locs) > 0:
+            x, y = np.where(mark_locs == 1)
+            for i in range(np.size(x)):
+                cv2.circle(img, (y[i], x[i]), 2, (0,0,255))
+    return img
+
+
+
+class AttrMap_hp:
+    def __init__(self, model_hp_trunk, model_hp_head, target_layer_names, use_cuda, head_only=False, samples=16,
+                 noise_level=0.15, memory_budget=2048):
+        self.model_hp_trunk = model_hp_trunk
+        self.model_hp_head = model_hp_head
+        self.model_hp_trunk.eval()
+        self.model_hp_head.eval()
+        self.cuda = use_cuda
+        self.samples = samples
+        self.noise_level = noise_level
+        self.memory_budget = memory_budget
+        if self.cuda:
+            self.model_hp_trunk = model_hp_trunk.cuda()
+            self.model_hp_head = model_hp_head.cuda()
+
+        self.extractor = ModelOutputs_hp(self.model_hp_trunk, self.model_hp_head, target_layer_names, head_only)
+
+    def forward(self, input):
+        return self.model_hp_head(self.model_hp_trunk(input))
+
+    def target_forward(self, input):
+        features, output = self.extractor(input)
+        return features[-1], output
+
+    def __call__(self, input):
+        if self.cuda:
+            input = input.cuda()
+
+        # all noisy copies in one batch (chunked by memory), averaged maps of (H, W)
+        heatmaps = smooth_gradcam(self.target_forward, input, self.samples, self.noise_level,
+                                  positive_gradients=True, memory_budget=self.memory_budget)
+        return heatmaps.cpu().data.numpy()
+
+
+class AttrMap_cls:
+    def __init__(self, model, target_layer_names, use_cuda, head_only=False, samples=16,
+                 noise_level=0.15, memory_budget=2048):
+        self.model = model
+        self.model.eval()
+        self.cuda = use_cuda
+        self.samples = samples
+        self.noise_level = noise_level
+        self.memory_budget = memory_budget
+        if self.cuda:
+            self.model = model.cuda()
+
+        self.extractor = ModelOutputs_cls(self.model, target_layer_names, head_only)
+
+    def forward(self, input):
+        return self.model(input)
+
+    def target_forward(self, input):
+        features, output = self.extractor(input)
+        return features[-1], output
+
+    def __call__(self, input, TopKclass = 5, topK_prob_predicted_classes=None):
+        if self.cuda:
+            input = input.cuda()
+
+        # (K, H, W) class maps of all noisy copies from batched backward passes
+        classifier_heatmaps = smooth_gradcam(self.target_forward, input, self.samples, self.noise_level,
+                                             classes=topK_prob_predicted_classes, memory_budget=self.memory_budget)
+        return classifier_heatmaps.permute(1, 2, 0).cpu().data.numpy()
+
+
+
+def insecurity_extraction(val_loader, attr_map_hp, attr_map_cls, imglist, topKcls, com_extracted_attributes, seg_list, topK_prob_predicted_classes, attributed, remaining_mask_size_pool, score_resolution='full', deviation_every=10, score_workers=0, result_dir=None):
+
+    # the scores of every example, on disk under result_dir; what they depend on is
+    # recorded with them so that a resumed run only adds to scores of the same evaluation
+    store = ResultStore(result_dir, ('IOU',), (len(imglist), np.size(remaining_mask_size_pool)),
+                        dict(evaluation=os.path.basename(__file__), topKcls=topKcls,
+                             score_resolution=score_resolution, mask_sizes=np.asarray(remaining_mask_size_pool).tolist()))
+    IOU = store['IOU']
+
+    deviation = AverageMeter()
+    pipeline = ScoringPipeline(score_workers)
+
+    def collect(finished):
+        for (index, example_deviation), scores in finished:
+            IOU[index] = scores
+            store.commit(index)
+            if example_deviation is not None and example_deviation.count > 0:
+                deviation.update(example_deviation.avg)
+
+    # examples none of whose top-K class pairs have common attributes score as if none of
+    # their atoms had any, whatever their heatmaps, so they are never attributed
+    skipped = np.flatnonzero(~attributed)
+    IOU[..., skipped, :] = 0.
+    store.commit((Ellipsis, skipped))
+
+    for i, (input, target, index) in enumerate(val_loader):
+        if store.done[i]:
+            continue
+        print('processing sample', i)
+
+
+        difficulty_heatmaps = attr_map_hp(input)
+
+        classifier_heatmaps = attr_map_cls(input, 1040, topK_prob_predicted_classes[i, :])
+        classifier_heatmaps[classifier_heatmaps < 0] = 1e-7
+
+        seg_img = seg_list[i]
+
+        example_deviation = AverageMeter() if deviation_every > 0 and i % deviation_every == 0 else None
+        collect(pipeline.submit((i, example_deviation), segment_insecurity_scores, difficulty_heatmaps, classifier_heatmaps, seg_img, com_extracted_attributes,
+                                topK_prob_predicted_classes[i, :], topKcls, remaining_mask_size_pool,
+                                resolution=score_resolution,
+                                deviation=example_deviation))
+
+    collect(pipeline.drain())
+
+    if score_resolution == 'native' and deviation.count > 0:
+        print('mean absolute deviation of the native resolution scores from full resolution', deviation.avg)
+    return np.nanmean(IOU, axis=0)
+
+
+
+if __name__ == '__main__':
+    main()
+
+
+
@@ -15,6 +15,9 @@ import models as models
 import matplotlib.pyplot as plt
 import torchvision.models as torch_models
 from extra_setting import *
+from attribution import *
+from insecurity import *
+from eval_cache import size_index, ResultStore, common_attribute_store, part_locations
 from torch.autograd import Variable
 from torch.autograd import Function
 from torchvision import utils
@@ -26,6 +29,7 @@ from sklearn.kernel_ridge import KernelRidge
 import cv2
 import seaborn as sns
 import operator
+import itertools
 
 
 model_names = sorted(name for name in models.__dict__
@@ -46,7 +50,44 @@ parser.add_argument('-b', '--batch-size', default=4, type=int,
                     metavar='N', help='mini-batch size (default: 200)')
 parser.add_argument('--resume', default='./cub200/checkpoint_res50_hp.pth.tar', type=str, metavar='PATH',
                     help='path to latest checkpoint (default: none)')
-
+parser.add_argument('--batched-cam', action='store_true',
+                    help='get all top-K class gradients in one batched backward pass')
+parser.add_argument('--head-only', action='store_true',
+                    help='freeze the weights and only backpropagate above the target layer')
+parser.add_argument('--hard-batch-size', default=8, type=int, metavar='N',
+                    help='mini-batch size of the hard examples during attribution (default: 8)')
+parser.add_argument('--target-layers', default=['layer4'], nargs='+', metavar='NAME',
+                    help='layers to attribute at, all from one forward and backward pass (default: layer4)')
+parser.add_argument('--layer-fusion', default='none', choices=['none', 'mean'],
+                    help='score each target layer on its own, or their mean after scaling each '
+                         'to a maximum of one (default: none)')
+parser.add_argument('--size-index', default='./cub200/CUB200_sizes_te.npy', type=str, metavar='PATH',
+                    help='(height, width) index of the test images, built from their headers if missing')
+parser.add_argument('--part-locs', default='./cub200/CUB200_partLocs_te', type=str, metavar='PATH',
+                    help='part location store of the test images, built from the CUB annotations if missing')
+parser.add_argument('--mask-size-step', default=0.01, type=float, metavar='Q',
+                    help='spacing of the remaining mask sizes the scores are reported at (default: 0.01)')
+parser.add_argument('--part-quantile', default='exact', choices=['exact', 'histogram'],
+                    help='threshold the upsampled insecurity maps at exact quantiles, or at quantiles of a '
+                         'histogram while only evaluating them at the part locations (default: exact)')
+parser.add_argument('--quantile-bins', default=4096, type=int, metavar='N',
+                    help='histogram bins of --part-quantile histogram (default: 4096)')
+parser.add_argument('--score-resolution', default='full', choices=['full', 'native'],
+                    help='threshold and score the insecurity maps upsampled to 224x224, or on the grid '
+                         'of the heatmaps for quick sweeps (default: full)')
+parser.add_argument('--deviation-every', default=10, type=int, metavar='N',
+                    help='with native resolution, also score every N-th example at full resolution and '
+                         'report the mean absolute deviation, 0 to disable (default: 10)')
+parser.add_argument('--score-workers', default=0, type=int, metavar='N',
+                    help='threads scoring the attributed examples while the next ones are attributed '
+                         '(default: 0, score each example in line)')
+parser.add_argument('--result-dir', default=None, type=str, metavar='PATH',
+                    help='directory the per-example scores are written to as they are computed, and a run '
+                         'resumed from (default: none, keep them in memory)')
+parser.add_argument('--segment-dir', default='./cub200/insecurities', type=str, metavar='PATH',
+                    help='directory the segments of the insecurity maps are drawn to, always thresholded at '
+                         'exact quantiles of the upsampled maps; empty to only score them '
+                         '(default: ./cub200/insecurities)')
 
 
 def main():
@@ -102,16 +143,18 @@ def main():
     # generate predicted hardness score
     criterion = nn.CrossEntropyLoss().cuda()
     criterion_f = nn.CrossEntropyLoss(reduce=False).cuda()
-    prec1, prec5, all_correct_te, all_predicted_te, all_class_dis_te = validate(val_loader, model_main, model_ahp_trunk,
+    prec1, prec5, all_correct_te, all_predicted_te, all_class_dis_te, confusion = validate(val_loader, model_main, model_ahp_trunk,
                                                                model_ahp_hp, criterion, criterion_f)
     all_predicted_te = all_predicted_te.astype(int)
     np.save('./cub200/all_correct_res_te.npy', all_correct_te)
     np.save('./cub200/all_predicted_res_te.npy', all_predicted_te)
     np.save('./cub200/all_class_dis_res_te.npy', all_class_dis_te)
+    confusion.save('./cub200/confusion_res_te.npz')
 
     all_correct_te = np.load('./cub200/all_correct_res_te.npy')
     all_predicted_te = np.load('./cub200/all_predicted_res_te.npy')
     all_class_dis_te = np.load('./cub200/all_class_dis_res_te.npy')
+    confusion = ConfusionMeter.load('./cub200/confusion_res_te.npz')
 
     difficulty_scores_te, difficulty_te_idx_each = save_predicted_difficulty(train_loader, val_loader, model_ahp_trunk, model_ahp_hp)
     np.save('./cub200/difficulty_scores_te.npy', difficulty_scores_te)
@@ -148,21 +191,19 @@ def main():
         picked_list.append(imlist[K_idx_incor_classified[i]])
         picked_class_list.append(imclass[K_idx_incor_classified[i]])
 
-    attr_map_hp = AttrMap_hp(model_ahp_trunk, model_ahp_hp, target_layer_names=["layer4"], use_cuda=True)
-    attr_map_cls = AttrMap_cls(model_main, target_layer_names=["layer4"], use_cuda=True)
-
-    com_extracted_attributes = np.load('./cub200/Dominik2003IT_com_extracted_attributes_02.npy')
-    all_locations = np.zeros((5794, 30))
-    with open('./cub200/CUB200_partLocs_gt_te.txt', 'r') as rf:
-        for line in rf.readlines():
-            locations = line.strip().split()
-            for i_part in range(30):
-                all_locations[int(locations[-1]), i_part] = round(float(locations[i_part]))
+    attr_map_hp = AttrMap_hp(model_ahp_trunk, model_ahp_hp, target_layer_names=args.target_layers, use_cuda=True, head_only=args.head_only)
+    attr_map_cls = AttrMap_cls(model_main, target_layer_names=args.target_layers, use_cuda=True, batched=args.batched_cam,
+                               head_only=args.head_only)
 
-    picked_locations = all_locations[K_idx_incor_classified, :]
+    com_extracted_attributes = common_attribute_store('./cub200/Dominik2003IT_com_extracted_attributes_02.npy', './cub200/Dominik2003IT_com_extracted_attributes_02')
+    all_locations, _ = part_locations(args.part_locs)
+    picked_locations = all_locations[K_idx_incor_classified]
+    image_sizes = size_index('./cub200/CUB200_gt_te.txt', args.size_index, args.workers)
+    picked_sizes = image_sizes[K_idx_incor_classified]
 
-    topK_prob_predicted_classes, _ = largest_indices_each_example(all_class_dis_te, 5)
+    topK_prob_predicted_classes, _ = confusion.topK_classes()
     picked_topK_prob_predicted_classes = topK_prob_predicted_classes[K_idx_incor_classified, :]
+    picked_attributed = confusion.attributed_examples(com_extracted_attributes)[K_idx_incor_classified]
 
     # save cub200 hard info
     cub200hard = './cub200/CUB200hard_gt_te.txt'
@@ -178,23 +219,27 @@ def main():
     get_dataset = getattr(datasets, 'cub200hard')
     num_classes = datasets._NUM_CLASSES['cub200hard']
     _, val_hard_loader = get_dataset(
-        batch_size=1, num_workers=args.workers)
+        batch_size=args.hard_batch_size, num_workers=args.workers)
 
 
-    remaining_mask_size_pool = np.arange(0.01, 1.0, 0.01)
+    remaining_mask_size_pool = np.arange(args.mask_size_step, 1.0, args.mask_size_step)
     recall, precision = insecurity_extraction(val_hard_loader, attr_map_hp, attr_map_cls,
-                                                                     picked_list, 3, com_extracted_attributes,
+                                                                     picked_sizes, 3, com_extracted_attributes,
                                                                      picked_locations,
-                                                                     picked_topK_prob_predicted_classes,
-                                                                     remaining_mask_size_pool)
+                                                                     picked_topK_prob_predicted_classes, picked_attributed,
+                                                                     remaining_mask_size_pool, args.layer_fusion, args.part_quantile, args.quantile_bins, args.score_resolution, args.deviation_every, args.score_workers, args.result_dir,
+                                                                     imglist=picked_list, segment_dir=args.segment_dir)
 
 
 
     print(recall)
     print(precision)
 
-    np.save('./cub200/hardness_score_res50_lastCovlayer_recall.npy', recall)
-    np.save('./cub200/hardness_score_res50_lastCovlayer_precision.npy', precision)
+    layers_tag = 'lastCovlayer' if args.target_layers == ['layer4'] else '_'.join(args.target_layers)
+    if args.layer_fusion == 'mean':
+        layers_tag = layers_tag + '_fused'
+    np.save('./cub200/hardness_score_res50_{}_recall.npy'.format(layers_tag), recall)
+    np.save('./cub200/hardness_score_res50_{}_precision.npy'.format(layers_tag), precision)
 
 
 
@@ -211,17 +256,19 @@ def validate(val_loader, model_main, model_ahp_trunk, model_ahp_hp, criterion, c
 
     all_correct_te = []
     all_predicted_te = []
-    all_class_dis = np.zeros((1, 200))
+    all_class_dis = []
+    confusion = ConfusionMeter(200, 5)
     for i, (input, target, index) in enumerate(val_loader):
 
         input = input.cuda()
-        target = target.cuda(async=True)
+        target = target.cuda(non_blocking=True)
 
         # compute output
         output, _ = model_main(input)
         class_dis = F.softmax(output, dim=1)
+        confusion.update(class_dis.data, target)
         class_dis = class_dis.data.cpu().numpy()
-        all_class_dis = np.concatenate((all_class_dis, class_dis), axis=0)
+        all_class_dis.append(class_dis)
 
         trunk_output, _ = model_ahp_trunk(input)
         predicted_hardness_scores, _ = model_ahp_hp(trunk_output)
@@ -253,8 +300,8 @@ def validate(val_loader, model_main, model_ahp_trunk, model_ahp_hp, criterion, c
                 i, len(val_loader), batch_time=batch_time,
                 top1=top1, top5=top5))
 
-    all_class_dis = all_class_dis[1:, :]
-    return top1.avg, top5.avg, all_correct_te, all_predicted_te, all_class_dis
+    all_class_dis = np.concatenate(all_class_dis, axis=0)
+    return top1.avg, top5.avg, all_correct_te, all_predicted_te, all_class_dis, confusion
 
 
 def largest_indices(ary, n):
@@ -265,16 +312,6 @@ def largest_indices(ary, n):
     return np.unravel_index(indices, ary.shape)
 
 
-def largest_indices_each_example(all_response, topK):
-    topK_maxIndex = np.zeros((np.size(all_response, 0), topK), dtype=np.int16)
-    topK_maxValue = np.zeros((np.size(all_response, 0), topK))
-    for i in range(np.size(topK_maxIndex, 0)):
-        arr = all_response[i, :]
-        topK_maxIndex[i, :] = np.argsort(arr)[-topK:][::-1]
-        topK_maxValue[i, :] = np.sort(arr)[-topK:][::-1]
-    return topK_maxIndex, topK_maxValue
-
-
 def save_predicted_difficulty(train_loader, val_loader, model_ahp_trunk, model_ahp_hp):
     model_ahp_trunk.eval()
     model_ahp_hp.eval()
@@ -341,72 +378,25 @@ def accuracy(output, target, topk=(1,)):
 
 
 
-class FeatureExtractor_hp():
-    """ Class for extracting activations and
-    registering gradients from targetted intermediate layers """
-    def __init__(self, model, target_layers):
-        self.model = model
-        self.target_layers = target_layers
-        self.gradients = []
-
-    def save_gradient(self, grad):
-        self.gradients.append(grad)
-
-    def __call__(self, x):
-        outputs = []
-        self.gradients = []
-        _, feature = self.model(x)
-        feature.register_hook(self.save_gradient)
-        outputs += [feature]
-        module = self.model.module._modules['avgpool']
-        output = module(feature)
-        output = output.view(output.size(0), -1)
-        module = self.model.module._modules['fc']
-        output = module(output)
-        return outputs, output
-
-
-class FeatureExtractor_cls():
-    """ Class for extracting activations and
-    registering gradients from targetted intermediate layers """
-    def __init__(self, model, target_layers):
-        self.model = model
-        self.target_layers = target_layers
-        self.gradients = []
-
-    def save_gradient(self, grad):
-        self.gradients.append(grad)
-
-    def __call__(self, x):
-        outputs = []
-        self.gradients = []
-        _, feature = self.model(x)
-        feature.register_hook(self.save_gradient)
-        outputs += [feature]
-        module = self.model.module._modules['avgpool']
-        output = module(feature)
-        output = output.view(output.size(0), -1)
-        module = self.model.module._modules['fc']
-        output = module(output)
-        return outputs, output
-
 class ModelOutputs_hp():
     """ Class for making a forward pass, and getting:
     1. The network output.
     2. Activations from intermeddiate targetted layers.
     3. Gradients from intermeddiate targetted layers. """
-    def __init__(self, model_hp_trunk, model_hp_head, target_layers):
+    def __init__(self, model_hp_trunk, model_hp_head, target_layers, head_only=False):
+        self.frozen_models = (model_hp_trunk, model_hp_head) if head_only else ()
         self.model_hp_trunk = model_hp_trunk
         self.model_hp_head = model_hp_head
-        self.feature_extractor = FeatureExtractor_hp(self.model_hp_trunk, target_layers)
+        self.feature_extractor = FeatureExtractor(self.model_hp_trunk, target_layers, head_only)
 
     def get_gradients(self):
         return self.feature_extractor.gradients
 
     def __call__(self, x):
-        target_activations, output  = self.feature_extractor(x)
-        _, output = self.model_hp_head(output)
-        return target_activations, output
+        with frozen_parameters(*self.frozen_models):
+            target_activations, output  = self.feature_extractor(x)
+            _, output = self.model_hp_head(output)
+            return target_activations, output
 
 
 class ModelOutputs_cls():
@@ -414,16 +404,18 @@ class ModelOutputs_cls():
     1. The network output.
     2. Activations from intermeddiate targetted layers.
     3. Gradients from intermeddiate targetted layers. """
-    def __init__(self, model, target_layers):
+    def __init__(self, model, target_layers, head_only=False):
+        self.frozen_models = (model,) if head_only else ()
         self.model = model
-        self.feature_extractor = FeatureExtractor_cls(self.model, target_layers)
+        self.feature_extractor = FeatureExtractor(self.model, target_layers, head_only)
 
     def get_gradients(self):
         return self.feature_extractor.gradients
 
     def __call__(self, x):
-        target_activations, output  = self.feature_extractor(x)
-        return target_activations, output
+        with frozen_parameters(*self.frozen_models):
+            target_activations, output  = self.feature_extractor(x)
+            return target_activations, output
 
 
 def preprocess_image(img):
@@ -478,7 +470,7 @@ def show_segment_on_image(img, mask, com_attributes_positions=None, all_attribut
 
 
 class AttrMap_hp:
-    def __init__(self, model_hp_trunk, model_hp_head, target_layer_names, use_cuda):
+    def __init__(self, model_hp_trunk, model_hp_head, target_layer_names, use_cuda, head_only=False):
         self.model_hp_trunk = model_hp_trunk
         self.model_hp_head = model_hp_head
         self.model_hp_trunk.eval()
@@ -488,184 +480,193 @@ class AttrMap_hp:
             self.model_hp_trunk = model_hp_trunk.cuda()
             self.model_hp_head = model_hp_head.cuda()
 
-        self.extractor = ModelOutputs_hp(self.model_hp_trunk, self.model_hp_head, target_layer_names)
+        self.target_layer_names = target_layer_names
+        self.extractor = ModelOutputs_hp(self.model_hp_trunk, self.model_hp_head, target_layer_names, head_only)
 
     def forward(self, input):
         return self.model_hp_head(self.model_hp_trunk(input))
 
-    def __call__(self, input):
+    def pyramid(self, input):
+        # (L, B, H, W) heatmaps of all target layers on the grid of the finest one
         if self.cuda:
             features, output = self.extractor(input.cuda())
         else:
             features, output = self.extractor(input)
 
-        self.model_hp_trunk.zero_grad()
-        self.model_hp_head.zero_grad()
-        output.backward(retain_graph=True)
-
-        grads_val = self.extractor.get_gradients()[-1].cpu().data.numpy()
-
-        gradients = np.copy(grads_val)
-        gradients[gradients < 0.0] = 0.0
-        gradients = gradients.squeeze()
-
-        target = features[-1]
-        target = target.cpu().data.numpy()[0, :]
+        # samples do not interact in eval mode, so differentiating the summed
+        # score gives each sample its own gradient in a single pass
+        grads_val = torch.autograd.grad(torch.sum(output), features)
 
-        heatmaps = target * gradients
-        heatmaps = np.sum(heatmaps, axis=0)
+        heatmaps = [gradcam_maps(target, torch.clamp(gradients, min=0.0)) for target, gradients in zip(features, grads_val)]
+        return resample_maps(heatmaps)
 
-        return heatmaps
+    def __call__(self, input):
+        heatmaps = self.pyramid(input)
+        return heatmaps[0] if len(heatmaps) == 1 else heatmaps
 
 
 class AttrMap_cls:
-    def __init__(self, model, target_layer_names, use_cuda):
+    def __init__(self, model, target_layer_names, use_cuda, batched=False, head_only=False):
         self.model = model
         self.model.eval()
         self.cuda = use_cuda
+        self.batched = batched
         if self.cuda:
             self.model = model.cuda()
 
-        self.extractor = ModelOutputs_cls(self.model, target_layer_names)
+        self.target_layer_names = target_layer_names
+        self.extractor = ModelOutputs_cls(self.model, target_layer_names, head_only)
 
     def forward(self, input):
         return self.model(input)
 
-    def __call__(self, input, TopKclass = 5, topK_prob_predicted_classes=None):
+    def pyramid(self, input, TopKclass = 5, topK_prob_predicted_classes=None):
+        # (L, B, H, W, K) heatmaps of all target layers on the grid of the finest one
         if self.cuda:
             features, output = self.extractor(input.cuda())
         else:
             features, output = self.extractor(input)
 
-        target = features[-1]
-        target = target.cpu().data.numpy()[0, :]
-
-        classifier_heatmaps = np.zeros((np.size(target,2), np.size(target,2), np.size(topK_prob_predicted_classes)))
-        for i_cls in range(np.size(topK_prob_predicted_classes)):
-            one_hot = np.zeros((1, output.size()[-1]), dtype=np.float32)
-            one_hot[0][topK_prob_predicted_classes[i_cls]] = 1
-            one_hot = Variable(torch.from_numpy(one_hot), requires_grad=True)
-            if self.cuda:
-                one_hot = torch.sum(one_hot.cuda() * output)
-            else:
-                one_hot = torch.sum(one_hot * output)
-            self.model.zero_grad()
-            one_hot.backward(retain_graph=True)
-            grads_val = self.extractor.get_gradients()[-1].cpu().data.numpy()
-            grads_val = grads_val.squeeze()
-            heatmaps = target * grads_val
-            heatmaps = np.sum(heatmaps, axis=0)
-            classifier_heatmaps[:, :, i_cls] = heatmaps
-
-        return classifier_heatmaps
-
-
-
-
-def insecurity_extraction(val_loader, attr_map_hp, attr_map_cls, imglist, topKcls, com_extracted_attributes, part_Locs, topK_prob_predicted_classes, remaining_mask_size_pool):
-
-
-    recall = np.zeros((len(imglist), np.size(remaining_mask_size_pool)))
-    precision = np.zeros((len(imglist), np.size(remaining_mask_size_pool)))
+        # one row of top-K classes per example in the batch
+        topK_prob_predicted_classes = np.reshape(topK_prob_predicted_classes, (output.size(0), -1))
 
-    for i, (input, target, index) in enumerate(val_loader):
-
-        print('processing sample', i)
-
-        img = cv2.imread(imglist[i])
-        img_X_max = np.size(img, axis=0)
-        img_Y_max = np.size(img, axis=1)
-        img = np.float32(cv2.resize(img, (224, 224))) / 255
-        difficulty_heatmaps = attr_map_hp(input)
-        classifier_heatmaps = attr_map_cls(input, 200, topK_prob_predicted_classes[i, :])
-        classifier_heatmaps[classifier_heatmaps < 0] = 1e-7
-
-        part_Locs_example = part_Locs[i, :]
-        part_Locs_example = np.concatenate((np.reshape(part_Locs_example[0::2], (-1, 1)), np.reshape(part_Locs_example[1::2], (-1, 1))), axis=1)
-        part_Locs_example[:, 0] = 224.0 * part_Locs_example[:, 0] / img_Y_max
-        part_Locs_example[:, 1] = 224.0 * part_Locs_example[:, 1] / img_X_max
-        part_Locs_example = np.round(part_Locs_example)
-        part_Locs_example = part_Locs_example.astype(int)
-
-
-        confusion_classes = np.argsort(classifier_heatmaps, axis=2)[:, :, -topKcls:]
-        confusion_classes = np.sort(confusion_classes, axis=2)
-
-        misclass_pairs = np.zeros((1, 2))
-        for i_cls in range(topKcls):
-            for j_cls in range(i_cls+1, topKcls):
-                cur_misclass_pairs = np.concatenate((np.reshape(confusion_classes[:,:,i_cls].squeeze(), (-1, 1)), np.reshape(confusion_classes[:,:,j_cls].squeeze(), (-1, 1))), axis=1)
-                misclass_pairs = np.concatenate((misclass_pairs, cur_misclass_pairs), axis=0)
-
-        misclass_pairs = np.unique(misclass_pairs, axis=0)
-        misclass_pairs = misclass_pairs[~np.all(misclass_pairs == 0, axis=1)]
-        misclass_pairs = misclass_pairs.astype(int)
-
-        atom_num = np.size(misclass_pairs, axis=0)
-
-
-        for i_remain in range(np.size(remaining_mask_size_pool)):
-            remaining_mask_size = remaining_mask_size_pool[i_remain]
-            noeffect_atom = 0
-            total_recall_i = 0
-            total_precision_i = 0
-            effective_atom_for_precision_i = 0
-            for i_atom in range(atom_num):
-
-
-                insecurity = classifier_heatmaps[:, :, misclass_pairs[i_atom, 0]].squeeze() * classifier_heatmaps[:, :, misclass_pairs[i_atom, 1]].squeeze() * difficulty_heatmaps
-                insecurity = cv2.resize(insecurity, (224, 224))
-                insecurity_mask = np.copy(insecurity)
-
-                threshold = np.sort(insecurity_mask.flatten())[int(-remaining_mask_size * 224 * 224)]
-                insecurity_mask[insecurity_mask > threshold] = 1
-                insecurity_mask[insecurity_mask < 1] = 0
-
-                all_attributes_positions = np.zeros((224, 224))
-                common_attributes_positions = np.zeros((224, 224))
-
-                com_attributes = com_extracted_attributes[topK_prob_predicted_classes[i, misclass_pairs[i_atom, 0]], topK_prob_predicted_classes[i, misclass_pairs[i_atom, 1]]]
-                if len(com_attributes) == 0:
-                    continue
-                com_attributes = np.array(com_attributes)
-
-                part_Locs_example_copy = np.copy(part_Locs_example)
-                part_Locs_example_copy = part_Locs_example_copy[~np.all(part_Locs_example_copy == 0, axis=1)]
-                all_attributes_positions[part_Locs_example_copy[:, 1], part_Locs_example_copy[:, 0]] = 1
-
-                common_attributes_positions[part_Locs_example[com_attributes, 1], part_Locs_example[com_attributes, 0]] = 1
-                common_attributes_positions[0, 0] = 0
-
-                if np.sum(common_attributes_positions) < 1:  # means no ground truth common attribute position
-                    noeffect_atom = noeffect_atom + 1
-                    continue
-
-
-                cur_recall = np.sum(insecurity_mask*common_attributes_positions) / np.sum(common_attributes_positions)
-
-
-                total_recall_i = total_recall_i + cur_recall
-                if np.sum(insecurity_mask*all_attributes_positions) > 0:
-
-                    cur_precision = np.sum(insecurity_mask*common_attributes_positions) / np.sum(insecurity_mask*all_attributes_positions)
-                    total_precision_i = total_precision_i + cur_precision
-                    effective_atom_for_precision_i = effective_atom_for_precision_i + 1
-
-                    # plot and save segments
-                    seg = show_segment_on_image(img, insecurity_mask, common_attributes_positions, all_attributes_positions, is_cls=False)
-                    info = imglist[i].split("/")
-                    name = info[-1]
-                    if not os.path.exists("./cub200/insecurities/"  + str(i)):
-                         os.makedirs("./cub200/insecurities/" +  str(i))
-                    cv2.imwrite("./cub200/insecurities/" + str(i) + "/" + str(remaining_mask_size) + "_" + str(topK_prob_predicted_classes[i, misclass_pairs[i_atom, 0]]) + "_" + str(topK_prob_predicted_classes[i, misclass_pairs[i_atom, 1]]) + "_" + name, seg)
+        if self.batched:
+            # (K, B, C, H, W) gradients of every layer from a single batched backward pass
+            grads_val = batched_class_gradients(output, features, topK_prob_predicted_classes)
+        else:
+            grads_val = []
+            for i_cls in range(np.size(topK_prob_predicted_classes, 1)):
+                one_hot = np.zeros((output.size(0), output.size()[-1]), dtype=np.float32)
+                one_hot[np.arange(output.size(0)), topK_prob_predicted_classes[:, i_cls]] = 1
+                one_hot = torch.sum(torch.from_numpy(one_hot).to(output.device) * output)
+                grads_val.append(torch.autograd.grad(one_hot, features, retain_graph=True))
+            grads_val = [torch.stack(gradients) for gradients in zip(*grads_val)]
 
-            recall[i, i_remain] = total_recall_i / (atom_num - noeffect_atom)
-            if effective_atom_for_precision_i > 0:
-                precision[i, i_remain] = total_precision_i / effective_atom_for_precision_i
-            else:
-                precision[i, i_remain] =float('NaN')
+        heatmaps = [gradcam_maps(target, gradients) for target, gradients in zip(features, grads_val)]
+        return resample_maps(heatmaps).permute(0, 2, 3, 4, 1)
 
-    return np.nanmean(recall, axis=0), np.nanmean(precision, axis=0)
+    def __call__(self, input, TopKclass = 5, topK_prob_predicted_classes=None):
+        heatmaps = self.pyramid(input, TopKclass, topK_prob_predicted_classes)
+        return heatmaps[0] if len(heatmaps) == 1 else heatmaps
+
+
+
+
+def save_insecurity_segments(imgpath, segment_dir, i, difficulty_heatmaps, classifier_heatmaps, part_Locs_example, com_extracted_attributes, topK_classes, topKcls, remaining_mask_size_pool):
+    """Draw the thresholded insecurity maps of the atoms of example i that count towards
+    precision onto the image, with their common (green) and other (red) part locations."""
+    img = cv2.imread(imgpath)
+    img = np.float32(cv2.resize(img, (224, 224))) / 255
+
+    # the upsampled maps at their exact quantiles, whatever the maps are scored at
+    atoms = confusion_atoms(classifier_heatmaps, topKcls)
+    maps = atom_insecurity_maps(difficulty_heatmaps, classifier_heatmaps, atoms)
+    thresholds = mask_thresholds(sort_maps(maps)[0], remaining_mask_size_pool)
+    com_masks = common_attribute_masks(com_extracted_attributes, topK_classes, atoms, width=len(part_Locs_example))
+    atom_precision = part_atom_scores(maps, thresholds, part_Locs_example, com_masks)[1]
+
+    all_attributes_positions = np.zeros((224, 224))
+    part_Locs_example_copy = part_Locs_example[~np.all(part_Locs_example == 0, axis=1)]
+    all_attributes_positions[part_Locs_example_copy[:, 1], part_Locs_example_copy[:, 0]] = 1
+    for i_remain, i_atom in zip(*np.nonzero(~np.isnan(atom_precision.cpu().numpy().T))):
+        remaining_mask_size = remaining_mask_size_pool[i_remain]
+        insecurity_mask = binarize_insecurity(maps[i_atom], thresholds[i_atom, i_remain]).cpu().numpy()
+        common_attributes_positions = np.zeros((224, 224))
+        common_attributes_positions[part_Locs_example[com_masks[i_atom], 1], part_Locs_example[com_masks[i_atom], 0]] = 1
+        common_attributes_positions[0, 0] = 0
+        seg = show_segment_on_image(img, insecurity_mask, common_attributes_positions, all_attributes_positions, is_cls=False)
+        name = imgpath.split("/")[-1]
+        os.makedirs(os.path.join(segment_dir, str(i)), exist_ok=True)
+        cv2.imwrite(os.path.join(segment_dir, str(i), str(remaining_mask_size) + "_" + str(topK_classes[atoms[i_atom, 0]]) + "_" + str(topK_classes[atoms[i_atom, 1]]) + "_" + name), seg)
+
+
+def insecurity_extraction(val_loader, attr_map_hp, attr_map_cls, imsizes, topKcls, com_extracted_attributes, part_Locs, topK_prob_predicted_classes, attributed, remaining_mask_size_pool, layer_fusion='none', part_quantile='exact', quantile_bins=4096, score_resolution='full', deviation_every=10, score_workers=0, result_dir=None, imglist=None, segment_dir=None):
+
+
+    # one row of results per target layer, or a single one for their fusion
+    num_layers = 1 if layer_fusion == 'mean' else len(attr_map_hp.target_layer_names)
+    # the scores of every example, on disk under result_dir; what they depend on is
+    # recorded with them so that a resumed run only adds to scores of the same evaluation
+    store = ResultStore(result_dir, ('recall', 'precision'), (num_layers, len(imsizes), np.size(remaining_mask_size_pool)),
+                        dict(evaluation=os.path.basename(__file__), topKcls=topKcls, layer_fusion=layer_fusion,
+                             layers=list(attr_map_hp.target_layer_names), part_quantile=part_quantile, quantile_bins=quantile_bins,
+                             score_resolution=score_resolution, mask_sizes=np.asarray(remaining_mask_size_pool).tolist()))
+    recall, precision = store['recall'], store['precision']
+    deviation = AverageMeter()
+    pipeline = ScoringPipeline(score_workers)
+
+    def collect(finished):
+        for (index, example_deviation), scores in finished:
+            recall[index], precision[index] = scores
+            store.commit(index)
+            if example_deviation is not None and example_deviation.count > 0:
+                deviation.update(example_deviation.avg)
+
+    # the segments of an example are drawn on the scoring threads as well
+    def draw_and_score(i, difficulty_heatmaps, classifier_heatmaps, part_Locs_example, example_deviation):
+        if segment_dir:
+            save_insecurity_segments(imglist[i], segment_dir, i, difficulty_heatmaps, classifier_heatmaps, part_Locs_example, com_extracted_attributes,
+                                     topK_prob_predicted_classes[i, :], topKcls, remaining_mask_size_pool)
+        return part_insecurity_scores(difficulty_heatmaps, classifier_heatmaps, part_Locs_example, com_extracted_attributes,
+                                      topK_prob_predicted_classes[i, :], topKcls, remaining_mask_size_pool,
+                                      part_quantile, quantile_bins,
+                                      resolution=score_resolution,
+                                      deviation=example_deviation)
+
+    # examples none of whose top-K class pairs have common attributes score as if none of
+    # their atoms had any, whatever their heatmaps, so they are never attributed
+    skipped = np.flatnonzero(~attributed)
+    recall[..., skipped, :], precision[..., skipped, :] = 0., np.nan
+    store.commit((Ellipsis, skipped))
+
+    i_start = 0
+    for input, target, index in val_loader:
+        # the examples of the batch still to score, the others are done or never attributed
+        batch_size = input.size(0)
+        todo = np.flatnonzero(~store.done[..., i_start:i_start + batch_size].reshape(-1, batch_size).all(axis=0))
+        if len(todo) == 0:
+            i_start = i_start + batch_size
+            continue
+        input = input[torch.as_tensor(todo)]
+        batch_difficulty_heatmaps = attr_map_hp.pyramid(input)
+        batch_classifier_heatmaps = attr_map_cls.pyramid(input, 200, topK_prob_predicted_classes[i_start + todo, :])
+        if layer_fusion == 'mean':
+            batch_difficulty_heatmaps = fuse_layer_maps(batch_difficulty_heatmaps)
+            batch_classifier_heatmaps = fuse_layer_maps(batch_classifier_heatmaps)
+        batch_difficulty_heatmaps = batch_difficulty_heatmaps.cpu().numpy()
+        batch_classifier_heatmaps = batch_classifier_heatmaps.cpu().numpy()
+
+        for i_layer, (i_batch, i) in itertools.product(range(num_layers), enumerate(i_start + todo)):
+            if store.done[i_layer, i]:
+                continue
+
+            print('processing sample', i)
+
+            img_X_max, img_Y_max = imsizes[i]
+            difficulty_heatmaps = batch_difficulty_heatmaps[i_layer, i_batch]
+            classifier_heatmaps = batch_classifier_heatmaps[i_layer, i_batch]
+            classifier_heatmaps[classifier_heatmaps < 0] = 1e-7
+
+            part_Locs_example = part_Locs[i].astype(np.float64)
+            part_Locs_example[:, 0] = 224.0 * part_Locs_example[:, 0] / img_Y_max
+            part_Locs_example[:, 1] = 224.0 * part_Locs_example[:, 1] / img_X_max
+            part_Locs_example = np.round(part_Locs_example)
+            part_Locs_example = part_Locs_example.astype(int)
+
+            example_deviation = AverageMeter() if deviation_every > 0 and i % deviation_every == 0 else None
+            collect(pipeline.submit(((i_layer, i), example_deviation), draw_and_score, i, difficulty_heatmaps, classifier_heatmaps, part_Locs_example,
+                                    example_deviation))
+        i_start = i_start + batch_size
+
+    collect(pipeline.drain())
+
+    if score_resolution == 'native' and deviation.count > 0:
+        print('mean absolute deviation of the native resolution scores from full resolution', deviation.avg)
+    recall = np.nanmean(recall, axis=1)
+    precision = np.nanmean(precision, axis=1)
+    if num_layers == 1:
+        return recall[0], precision[0]
+    return recall, precision
 
 
 
@@ -0,0 +1,134 @@
+import torch
+import torch.nn as nn
+
+from attribution import *
+
+
+def toy_network(seed=0):
+    """forward(x) -> (feature, output) of a conv trunk and a nonlinear head."""
+    torch.manual_seed(seed)
+    trunk = nn.Sequential(nn.Conv2d(3, 4, 3, padding=1), nn.Tanh())
+    head = nn.Sequential(nn.Flatten(), nn.Linear(4 * 6 * 6, 8), nn.Tanh(), nn.Linear(8, 5))
+    trunk.double()
+    head.double()
+
+    def forward(x):
+        feature = trunk(x)
+        return feature, head(feature)
+    return trunk, head, forward
+
+
+def test_batched_class_gradients_match_per_class_backward():
+    _, _, forward = toy_network()
+    x = torch.randn(2, 3, 6, 6, dtype=torch.float64)
+    feature, output = forward(x)
+    classes = torch.tensor([[1, 4], [3, 0]])
+    gradients = batched_class_gradients(output, feature, classes)
+    for k in range(2):
+        selected = output[torch.arange(2), classes[:, k]].sum()
+        expected = torch.autograd.grad(selected, feature, retain_graph=True)[0]
+        torch.testing.assert_close(gradients[k], expected)
+
+
+def test_integrated_gradients_match_riemann_sum():
+    _, _, forward = toy_network()
+    x = torch.randn(1, 3, 6, 6, dtype=torch.float64)
+    refer = torch.zeros_like(x)
+    step = 10
+    expected = 0
+    for i in range(step + 1):
+        feature, output = forward(refer + (i / step) * (x - refer))
+        expected = expected + torch.autograd.grad(output[0, 2], feature)[0][0]
+    expected = expected / (step + 1)
+    # one point per chunk and all points in one chunk
+    for memory_budget in (1e-9, 2048):
+        gradients, feature, refer_feature = integrated_gradients(forward, x, refer, step, classes=[2, 3],
+                                                                 memory_budget=memory_budget)
+        torch.testing.assert_close(gradients[0], expected)
+        torch.testing.assert_close(feature, forward(x)[0].detach())
+        torch.testing.assert_close(refer_feature, forward(refer)[0].detach())
+
+
+def test_adaptive_integrated_gradients_reuse_the_coarser_steps():
+    _, _, forward = toy_network()
+    x = 3 * torch.randn(1, 3, 6, 6, dtype=torch.float64)
+    refer = torch.zeros_like(x)
+    steps = []
+    for tolerance in (0.1, 1e-3, 1e-6):
+        gradients, _, _, step = adaptive_integrated_gradients(forward, x, refer, step=4, max_step=64, tolerance=tolerance)
+        torch.testing.assert_close(gradients, integrated_gradients(forward, x, refer, step)[0])
+        steps.append(step)
+    assert steps == sorted(steps) and steps[-1] <= 64
+
+
+def test_chunk_points_count_the_classes():
+    assert chunk_points(1, 2 ** 10) == 2 ** 10
+    assert chunk_points(1, 2 ** 10, classes=[1, 2, 3, 4]) == 2 ** 8
+    assert chunk_points(1, 2 ** 30) == 1
+
+
+def location_hessian_blocks(head, feature):
+    """a_l^T H_l a_l of every location from the full Hessian of the head."""
+    hessian = torch.autograd.functional.hessian(lambda f: head(f)[0, 0], feature)
+    channels, height, width = feature.shape[1:]
+    hessian = hessian.reshape(channels, height * width, channels, height * width)
+    activation = feature[0].reshape(channels, height * width)
+    return torch.stack([activation[:, l] @ hessian[:, l, :, l] @ activation[:, l]
+                        for l in range(height * width)]).view(height, width)
+
+
+def test_location_hessian_quadratic_matches_the_exact_hessian():
+    trunk, head, _ = toy_network()
+    feature = trunk(torch.randn(1, 3, 6, 6, dtype=torch.float64)).detach().requires_grad_()
+    expected = location_hessian_blocks(head, feature)
+    for chunk in (None, 7):
+        gradients, quadratic = location_hessian_quadratic(head(feature)[0, 0], feature, chunk)
+        torch.testing.assert_close(quadratic, expected)
+        torch.testing.assert_close(gradients, torch.autograd.grad(head(feature)[0, 0], feature)[0][0])
+
+
+def test_hutchinson_estimate_is_unbiased():
+    trunk, head, _ = toy_network()
+    feature = trunk(torch.randn(1, 3, 6, 6, dtype=torch.float64)).detach().requires_grad_()
+    expected = location_hessian_blocks(head, feature)
+    torch.manual_seed(0)
+    _, mean, stderr = hutchinson_location_quadratic(head(feature)[0, 0], feature, probes=2048, chunk=512)
+    assert torch.all(torch.abs(mean - expected) <= 5 * stderr + 1e-12)
+    assert torch.isnan(hutchinson_location_quadratic(head(feature)[0, 0], feature, probes=1)[2]).all()
+
+
+def test_smooth_gradcam_does_not_depend_on_the_chunks():
+    _, _, forward = toy_network()
+    x = torch.randn(1, 3, 6, 6, dtype=torch.float64)
+    maps = []
+    for memory_budget in (1e-9, 2048):
+        torch.manual_seed(0)
+        maps.append(smooth_gradcam(forward, x, samples=5, classes=[1, 2], memory_budget=memory_budget))
+    torch.testing.assert_close(maps[0], maps[1])
+    assert maps[0].shape == (2, 6, 6)
+
+
+def test_feature_extractor_cuts_the_graph_at_the_target_layer():
+    trunk, head, _ = toy_network()
+    model = nn.Sequential(trunk, head)
+    x = torch.randn(2, 3, 6, 6, dtype=torch.float64)
+    features, output = FeatureExtractor(model, ['0.1'])(x)
+    full = torch.autograd.grad(output.sum(), features[0])[0]
+    features, output = FeatureExtractor(model, ['0.1'], head_only=True)(x)
+    torch.testing.assert_close(torch.autograd.grad(output.sum(), features[0])[0], full)
+    assert features[0].grad_fn is None
+    torch.testing.assert_close(FeatureExtractor(nn.DataParallel(model), ['0.1'])(x)[1], output)
+
+
+def test_frozen_parameters_restore_the_flags():
+    trunk, head, forward = toy_network()
+    head[1].weight.requires_grad_(False)
+    flags = [param.requires_grad for param in head.parameters()]
+    with frozen_parameters(trunk, head):
+        feature, output = forward(torch.randn(1, 3, 6, 6, dtype=torch.float64).requires_grad_())
+        assert not any(param.requires_grad for param in head.parameters())
+    assert [param.requires_grad for param in head.parameters()] == flags
+    assert all(param.requires_grad for param in trunk.parameters())
+    output.sum().backward()
+    assert all(param.grad is None for param in trunk.parameters())
+    assert all(param.grad is None for param in head.parameters())
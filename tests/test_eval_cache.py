@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+
+from eval_cache import *
+
+
+def common_attributes(seed=0, num_classes=6, width=15):
+    rng = np.random.RandomState(seed)
+    com = np.empty((num_classes, num_classes), dtype=object)
+    for a in range(num_classes):
+        for b in range(num_classes):
+            com[a, b] = sorted(rng.choice(width, rng.randint(0, 4), replace=False).tolist())
+    return com
+
+
+def test_common_attribute_store_matches_the_object_array(tmp_path):
+    com = common_attributes()
+    save_common_attributes(com, str(tmp_path / 'com'))
+    store = CommonAttributeStore(str(tmp_path / 'com'))
+    a, b = np.meshgrid(np.arange(6), np.arange(6), indexing='ij')
+    a, b = a.flatten(), b.flatten()
+    np.testing.assert_array_equal(store.counts(a, b), [len(com[i, j]) for i, j in zip(a, b)])
+    for i, j, attributes in zip(a, b, store.lookup(a, b)):
+        assert list(attributes) == com[i, j]
+        assert list(store[i, j]) == com[i, j]
+    masks = store.masks(a, b, width=15)
+    for i, j, mask in zip(a, b, masks):
+        assert list(np.flatnonzero(mask)) == com[i, j]
+    assert store.lookup([], []) == []
+
+
+@pytest.mark.filterwarnings('ignore:Mean of empty slice')
+def test_result_store_resumes_the_committed_rows(tmp_path):
+    path = str(tmp_path / 'results')
+    config = dict(evaluation='test', mask_sizes=[0.1, 0.2, 0.3])
+    store = ResultStore(path, ('recall', 'steps'), (2, 4, 3), config, row_shapes=dict(steps=()))
+    assert np.isnan(store['recall']).all() and not store.done.any()
+    store['recall'][0, 1] = [0.1, 0.2, 0.3]
+    store['steps'][0, 1] = 16
+    store.commit((0, 1))
+    store['recall'][1, 2] = [1., 1., 1.]
+    store.commit((Ellipsis, [3]))
+    # written but never committed, as if the run stopped here
+    store['recall'][1, 0] = [5., 5., 5.]
+    del store
+
+    store = ResultStore(path, ('recall', 'steps'), (2, 4, 3), config, row_shapes=dict(steps=()))
+    np.testing.assert_array_equal(np.argwhere(store.done), [[0, 1], [0, 3], [1, 3]])
+    np.testing.assert_array_equal(store['recall'][0, 1], [0.1, 0.2, 0.3])
+    assert store['steps'][0, 1] == 16 and store['steps'].shape == (2, 4)
+    store['recall'][1, 0] = [0.5, 0.5, 0.5]
+    store.commit((1, 0))
+
+    curves, done = result_curves(path)
+    np.testing.assert_array_equal(done, [2, 2])
+    np.testing.assert_allclose(curves['recall'], [[0.1, 0.2, 0.3], [0.75, 0.75, 0.75]])
+    np.testing.assert_array_equal(curves['steps'], [16, np.nan])
+
+
+def test_result_store_refuses_another_configuration(tmp_path):
+    path = str(tmp_path / 'results')
+    ResultStore(path, ('IOU',), (4, 3), dict(score_resolution='full'))
+    with pytest.raises(ValueError):
+        ResultStore(path, ('IOU',), (4, 3), dict(score_resolution='native'))
+    with pytest.raises(ValueError):
+        ResultStore(path, ('IOU',), (5, 3), dict(score_resolution='full'))
+
+
+def test_result_store_in_memory():
+    store = ResultStore(None, ('IOU', 'stderr'), (4, 3), row_shapes=dict(stderr=(2, 2)))
+    store['stderr'][1] = np.ones((2, 2))
+    store.commit(1)
+    assert store['stderr'].shape == (4, 2, 2) and store.done.tolist() == [False, True, False, False]
@@ -0,0 +1,273 @@
+import itertools
+import cv2
+import numpy as np
+import pytest
+import torch
+
+from eval_cache import save_common_attributes, CommonAttributeStore
+from insecurity import *
+
+
+POOL = np.arange(0.01, 1.0, 0.01)
+
+
+def loop_atoms(classifier_heatmaps, topKcls):
+    # the confusion atoms as the per-pair evaluation found them
+    confusion_classes = np.argsort(classifier_heatmaps, axis=2)[:, :, -topKcls:]
+    confusion_classes = np.sort(confusion_classes, axis=2)
+    misclass_pairs = np.zeros((1, 2))
+    for i_cls in range(topKcls):
+        for j_cls in range(i_cls + 1, topKcls):
+            cur_misclass_pairs = np.concatenate((np.reshape(confusion_classes[:, :, i_cls], (-1, 1)),
+                                                 np.reshape(confusion_classes[:, :, j_cls], (-1, 1))), axis=1)
+            misclass_pairs = np.concatenate((misclass_pairs, cur_misclass_pairs), axis=0)
+    misclass_pairs = np.unique(misclass_pairs, axis=0)
+    misclass_pairs = misclass_pairs[~np.all(misclass_pairs == 0, axis=1)]
+    return misclass_pairs.astype(int)
+
+
+def loop_insecurity_mask(difficulty_heatmaps, classifier_heatmaps, atom, remaining_mask_size):
+    insecurity = classifier_heatmaps[:, :, atom[0]] * classifier_heatmaps[:, :, atom[1]] * difficulty_heatmaps
+    insecurity_mask = cv2.resize(insecurity, (224, 224))
+    threshold = np.sort(insecurity_mask.flatten())[int(-remaining_mask_size * 224 * 224)]
+    insecurity_mask[insecurity_mask > threshold] = 1
+    insecurity_mask[insecurity_mask < 1] = 0
+    return insecurity_mask
+
+
+def loop_part_scores(difficulty_heatmaps, classifier_heatmaps, part_locs, com_extracted_attributes, topK_classes,
+                     topKcls, remaining_mask_size_pool):
+    """Recall and precision of one example with the loops over mask sizes and atoms."""
+    misclass_pairs = loop_atoms(classifier_heatmaps, topKcls)
+    atom_num = len(misclass_pairs)
+    recall = np.zeros(len(remaining_mask_size_pool))
+    precision = np.zeros(len(remaining_mask_size_pool))
+    for i_remain, remaining_mask_size in enumerate(remaining_mask_size_pool):
+        noeffect_atom = 0
+        total_recall_i = 0
+        total_precision_i = 0
+        effective_atom_for_precision_i = 0
+        for atom in misclass_pairs:
+            insecurity_mask = loop_insecurity_mask(difficulty_heatmaps, classifier_heatmaps, atom, remaining_mask_size)
+            com_attributes = com_extracted_attributes[topK_classes[atom[0]], topK_classes[atom[1]]]
+            if len(com_attributes) == 0:
+                continue
+            com_attributes = np.array(com_attributes)
+
+            all_attributes_positions = np.zeros((224, 224))
+            common_attributes_positions = np.zeros((224, 224))
+            visible = part_locs[~np.all(part_locs == 0, axis=1)]
+            all_attributes_positions[visible[:, 1], visible[:, 0]] = 1
+            common_attributes_positions[part_locs[com_attributes, 1], part_locs[com_attributes, 0]] = 1
+            common_attributes_positions[0, 0] = 0
+            if np.sum(common_attributes_positions) < 1:
+                noeffect_atom = noeffect_atom + 1
+                continue
+
+            total_recall_i = total_recall_i + np.sum(insecurity_mask * common_attributes_positions) / np.sum(common_attributes_positions)
+            if np.sum(insecurity_mask * all_attributes_positions) > 0:
+                total_precision_i = total_precision_i + np.sum(insecurity_mask * common_attributes_positions) / np.sum(insecurity_mask * all_attributes_positions)
+                effective_atom_for_precision_i = effective_atom_for_precision_i + 1
+        recall[i_remain] = total_recall_i / (atom_num - noeffect_atom)
+        precision[i_remain] = total_precision_i / effective_atom_for_precision_i if effective_atom_for_precision_i > 0 else np.nan
+    return recall, precision
+
+
+def loop_segment_scores(difficulty_heatmaps, classifier_heatmaps, seg_img, com_extracted_attributes, topK_classes,
+                        topKcls, remaining_mask_size_pool):
+    """IOU of one example with the loops over mask sizes and atoms."""
+    misclass_pairs = loop_atoms(classifier_heatmaps, topKcls)
+    IOU = np.zeros(len(remaining_mask_size_pool))
+    for i_remain, remaining_mask_size in enumerate(remaining_mask_size_pool):
+        total_IOU_i = 0
+        for atom in misclass_pairs:
+            insecurity_mask = loop_insecurity_mask(difficulty_heatmaps, classifier_heatmaps, atom, remaining_mask_size)
+            com_attributes = com_extracted_attributes[topK_classes[atom[0]], topK_classes[atom[1]]]
+            if len(com_attributes) == 0:
+                continue
+            commom_seg_img = np.zeros((224, 224))
+            for com_attribute in com_attributes:
+                commom_seg_img[seg_img == com_attribute] = 1
+            total_IOU_i = total_IOU_i + np.sum(insecurity_mask * commom_seg_img) / np.sum(insecurity_mask + commom_seg_img - insecurity_mask * commom_seg_img)
+        IOU[i_remain] = total_IOU_i / len(misclass_pairs)
+    return IOU
+
+
+def example(seed, num_classes=10, width=15, grid=7):
+    """Heatmaps of one example, its top-5 classes and common attributes of
+    every class pair (some empty), as an object array and a store."""
+    rng = np.random.RandomState(seed)
+    # values of at least one below the threshold keep their value in the masks
+    difficulty_heatmaps = rng.rand(grid, grid) * 1.3
+    classifier_heatmaps = rng.rand(grid, grid, 5) * 1.3
+    topK_classes = rng.permutation(num_classes)[:5].astype(np.int16)
+    com = np.empty((num_classes, num_classes), dtype=object)
+    for a in range(num_classes):
+        for b in range(num_classes):
+            com[a, b] = sorted(rng.choice(width, rng.randint(0, 4), replace=False).tolist())
+    return rng, difficulty_heatmaps, classifier_heatmaps, topK_classes, com
+
+
+@pytest.fixture
+def attribute_store(tmp_path):
+    def make(com):
+        save_common_attributes(com, str(tmp_path / 'com'))
+        return CommonAttributeStore(str(tmp_path / 'com'))
+    return make
+
+
+def part_locations(rng, parts=15):
+    part_locs = rng.randint(0, 224, (parts, 2))
+    part_locs[rng.rand(parts) < 0.2] = 0
+    return part_locs
+
+
+def test_confusion_atoms_match_loop():
+    for seed in range(5):
+        classifier_heatmaps = example(seed)[2]
+        np.testing.assert_array_equal(confusion_atoms(classifier_heatmaps, 3), loop_atoms(classifier_heatmaps, 3))
+
+
+def test_masked_sums_match_masks():
+    rng = np.random.RandomState(0)
+    values = torch.as_tensor(rng.rand(4, 300) * 1.5)
+    weights = torch.as_tensor(rng.rand(4, 300))
+    thresholds = torch.as_tensor(rng.rand(4, 6) * 1.5)
+    sorted_values, order = torch.sort(values, dim=1)
+    sums = masked_sums(sorted_values, torch.gather(weights, 1, order), thresholds)
+    expected = (binarize_insecurity(values[:, None, :], thresholds[:, :, None]) * weights[:, None, :]).sum(dim=2)
+    np.testing.assert_allclose(sums.numpy(), expected.numpy(), rtol=1e-10)
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_part_scores_match_loop(seed, attribute_store):
+    rng, difficulty_heatmaps, classifier_heatmaps, topK_classes, com = example(seed)
+    part_locs = part_locations(rng)
+    recall, precision = part_insecurity_scores(difficulty_heatmaps, classifier_heatmaps, part_locs, attribute_store(com),
+                                               topK_classes, 3, POOL)
+    loop_recall, loop_precision = loop_part_scores(difficulty_heatmaps, classifier_heatmaps, part_locs, com,
+                                                   topK_classes, 3, POOL)
+    np.testing.assert_allclose(recall, loop_recall, rtol=1e-10)
+    np.testing.assert_allclose(precision, loop_precision, rtol=1e-10)
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_segment_scores_match_loop(seed, attribute_store):
+    rng, difficulty_heatmaps, classifier_heatmaps, topK_classes, com = example(seed)
+    seg_img = rng.randint(0, 15, (224, 224))
+    IOU = segment_insecurity_scores(difficulty_heatmaps, classifier_heatmaps, seg_img, attribute_store(com),
+                                    topK_classes, 3, POOL)
+    loop_IOU = loop_segment_scores(difficulty_heatmaps, classifier_heatmaps, seg_img, com, topK_classes, 3, POOL)
+    np.testing.assert_allclose(IOU, loop_IOU, rtol=1e-10)
+
+
+def test_histogram_thresholds_keep_the_mask_sizes():
+    rng = np.random.RandomState(0)
+    maps = torch.as_tensor(rng.rand(3, 7, 7))
+    thresholds = histogram_thresholds(maps, POOL)
+    upsampled = torch.nn.functional.interpolate(maps.unsqueeze(1), size=(224, 224), mode='bilinear',
+                                                align_corners=False)[:, 0]
+    exact = mask_thresholds(sort_maps(upsampled)[0], POOL)
+    kept = (upsampled.flatten(start_dim=1)[:, :, None] > thresholds[:, None, :]).sum(dim=1)
+    kept_exact = (upsampled.flatten(start_dim=1)[:, :, None] > exact[:, None, :]).sum(dim=1)
+    # the thresholds are interpolated inside a bin, the masks they keep are within 1% of the image
+    assert (kept - kept_exact).abs().max() <= 0.01 * 224 * 224
+    assert (kept - kept_exact).abs().double().median() <= 8
+
+
+def test_histogram_part_scores_close_to_exact(attribute_store):
+    rng, difficulty_heatmaps, classifier_heatmaps, topK_classes, com = example(0)
+    part_locs = part_locations(rng)
+    store = attribute_store(com)
+    exact = part_insecurity_scores(difficulty_heatmaps, classifier_heatmaps, part_locs, store, topK_classes, 3, POOL)
+    histogram = part_insecurity_scores(difficulty_heatmaps, classifier_heatmaps, part_locs, store, topK_classes, 3, POOL,
+                                       quantile='histogram')
+    for a, b in zip(exact, histogram):
+        assert np.array_equal(np.isnan(a), np.isnan(b))
+        assert np.nanmean(np.abs(a - b)) < 0.02
+
+
+def test_native_scores_at_the_map_resolution_match_full():
+    # on a grid as fine as the image, the bilinear and area weights are the identity
+    rng = np.random.RandomState(0)
+    maps = torch.as_tensor(rng.rand(3, 16, 16) * 1.3)
+    sorted_maps, order = sort_maps(maps)
+    thresholds = mask_thresholds(sorted_maps, POOL)
+    com_masks = rng.rand(3, 15) < 0.3
+    com_masks[2] = False
+    part_locs = part_locations(rng)
+    part_locs = part_locs * 16 // 224
+    full = part_atom_scores(maps, thresholds, part_locs, com_masks)
+    native = native_part_atom_scores(sorted_maps, order, thresholds, (16, 16), part_locs, com_masks, size=16)
+    for a, b in zip(full, native):
+        np.testing.assert_allclose(a.numpy(), b.numpy(), rtol=1e-10)
+
+    seg_img = rng.randint(0, 15, (16, 16))
+    np.testing.assert_allclose(native_segment_atom_scores(sorted_maps, order, thresholds, (16, 16), seg_img, com_masks).numpy(),
+                               segment_atom_scores(sorted_maps, order, thresholds, seg_img, com_masks).numpy(), rtol=1e-10)
+
+
+def test_sampled_maps_match_upsampling():
+    rng = np.random.RandomState(0)
+    maps = torch.as_tensor(rng.rand(2, 7, 7))
+    upsampled = torch.nn.functional.interpolate(maps.unsqueeze(1), size=(224, 224), mode='bilinear',
+                                                align_corners=False)[:, 0]
+    ys, xs = rng.randint(0, 224, 20), rng.randint(0, 224, 20)
+    np.testing.assert_allclose(sample_insecurity_maps(maps, ys, xs).numpy(), upsampled[:, ys, xs].numpy(), rtol=1e-10)
+
+
+def test_attributed_examples(attribute_store):
+    com = np.empty((6, 6), dtype=object)
+    for a in range(6):
+        for b in range(6):
+            com[a, b] = []
+    com[1, 0] = [2]
+    com[3, 4] = [0, 1]
+    confusion = ConfusionMeter(6, 3)
+    class_dis = np.zeros((4, 6))
+    for row, classes in enumerate([[0, 1, 2], [2, 5, 3], [4, 2, 3], [5, 2, 0]]):
+        class_dis[row, classes] = [3, 2, 1]
+    confusion.update(torch.as_tensor(class_dis[:2]), [1, 2])
+    confusion.update(torch.as_tensor(class_dis[2:]), [2, 2])
+    np.testing.assert_array_equal(confusion.topK_classes()[0], [[0, 1, 2], [2, 5, 3], [4, 2, 3], [5, 2, 0]])
+    np.testing.assert_array_equal(confusion.attributed_examples(attribute_store(com)), [True, False, True, False])
+
+
+def test_confusion_meter_ranks_the_pairs_and_reloads(tmp_path):
+    rng = np.random.RandomState(0)
+    class_dis = rng.rand(50, 8)
+    target = rng.randint(0, 8, 50)
+    confusion = ConfusionMeter(8, 3)
+    for start in range(0, 50, 16):
+        confusion.update(torch.as_tensor(class_dis[start:start + 16]), torch.as_tensor(target[start:start + 16]))
+
+    expected = np.zeros((8, 8), dtype=int)
+    np.add.at(expected, (target, class_dis.argmax(axis=1)), 1)
+    np.testing.assert_array_equal(confusion.confusion_matrix(), expected)
+
+    pairs, confusions, corankings = confusion.confusable_pairs()
+    top3 = np.argsort(-class_dis, axis=1)[:, :3]
+    for (a, b), mistaken, coranked in zip(pairs, confusions, corankings):
+        assert a < b
+        assert mistaken == expected[a, b] + expected[b, a]
+        assert coranked == np.sum(np.isin(top3, a).any(axis=1) & np.isin(top3, b).any(axis=1))
+    coranked_pairs = {tuple(sorted(pair)) for classes in top3 for pair in itertools.combinations(classes, 2)}
+    assert set(map(tuple, pairs.tolist())) == coranked_pairs
+    assert list(zip(-confusions, -corankings)) == sorted(zip(-confusions, -corankings))
+
+    confusion.save(str(tmp_path / 'confusion.npz'))
+    loaded = ConfusionMeter.load(str(tmp_path / 'confusion.npz'))
+    assert (loaded.num_classes, loaded.topK) == (8, 3)
+    for a, b in zip(loaded.topK_classes(), confusion.topK_classes()):
+        np.testing.assert_array_equal(a, b)
+    for a, b in zip(loaded.confusable_pairs(), confusion.confusable_pairs()):
+        np.testing.assert_array_equal(a, b)
+
+
+def test_scoring_pipeline_keeps_the_order():
+    pipeline = ScoringPipeline(3, max_pending=2)
+    finished = []
+    for i in range(10):
+        finished += pipeline.submit(i, lambda i: i * i, i)
+    finished += pipeline.drain()
+    assert finished == [(i, i * i) for i in range(10)]